@@ -0,0 +1,573 @@
+import os,sys,json
+import time
+import pickle
+import shutil
+import platform
+import subprocess
+import tempfile
+import asyncio
+from collections import Counter
+import numpy as np
+import scipy.stats
+import matplotlib
+matplotlib.use("Agg")
+import word2vec_v2 as w2v
+try:
+    import resource
+except ImportError:
+    resource = None                     #... not available on Windows: peak RSS is reported as null
+
+
+#... Benchmarks for the word2vec training and query paths.
+#... Everything runs on synthetic Zipf-distributed corpora, so no network or external data is needed
+#... (precision can optionally use the saved model instead).
+#...
+#...     python benchmark.py threads [num_tokens] [max_threads]
+#...     python benchmark.py ann [vocab_size] [num_queries]
+#...     python benchmark.py sigmoid [num_tokens]
+#...     python benchmark.py models [num_tokens] [num_threads]
+#...     python benchmark.py precision [vocab_size] [num_queries] [trained]
+#...     python benchmark.py pipeline [num_tokens] [vocab_size] [output.jsonl]
+#...     python benchmark.py server [vocab_size] [num_requests] [concurrency]
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... synthetic corpus generation
+#.................................................................................
+
+
+def zipfSequence(num_tokens, vocab_size, exponent=1.0, seed=10):
+    #... draw an encoded int32 token stream whose index frequencies follow a Zipf law,
+    #... i.e. index 0 is the most frequent word just like in a real uniqueWords ordering.
+    rng = np.random.RandomState(seed)
+    prob = 1.0 / np.arange(1, vocab_size + 1) ** exponent
+    prob /= prob.sum()
+    return rng.choice(vocab_size, size=num_tokens, p=prob).astype(np.int32)
+
+
+def writeZipfCorpus(filename, num_tokens, vocab_size, exponent=1.0, record_tokens=200, seed=10):
+    #... write a Zipf-distributed corpus in the input format of loadData(): an "id<TAB>review" header and
+    #... one record of record_tokens words per line. Words are "w<rank>" so no word is a stopword.
+    sequence = zipfSequence(num_tokens, vocab_size, exponent, seed)
+    words = np.array(["w%d" % i for i in range(vocab_size)])
+    handle = open(filename, "w", encoding="utf8")
+    handle.write(u"id\treview\n")
+    for record, start in enumerate(range(0, num_tokens, record_tokens)):
+        handle.write(u"r%d\t%s\n" % (record, " ".join(words[sequence[start:start+record_tokens]])))
+    handle.close()
+    return sequence
+
+
+def setupSyntheticModel(num_tokens, vocab_size=10000, exponent=1.0, seed=10):
+    #... populate the word2vec_v2 globals (uniqueWords, wordcodes, wordcounts, fullsequence, samplingTable)
+    #... as loadData() and negativeSampleTable() would for a corpus of num_tokens tokens.
+    sequence = zipfSequence(num_tokens, vocab_size, exponent, seed)
+    counts = np.bincount(sequence, minlength=vocab_size)
+    w2v.uniqueWords = ["w%d" % i for i in range(vocab_size)]
+    w2v.wordcodes = {word: i for i, word in enumerate(w2v.uniqueWords)}
+    w2v.wordcounts = Counter({w2v.uniqueWords[i]: int(counts[i]) for i in range(vocab_size)})
+    w2v.fullsequence = sequence
+    w2v.samplingTable = w2v.negativeSampleTable(sequence, w2v.uniqueWords, w2v.wordcounts)
+    return sequence
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... Hogwild thread scaling of the training kernel
+#.................................................................................
+
+
+def benchmarkThreads(num_tokens=2000000, max_threads=None, epochs=1):
+    #... train one model per thread count on the same corpus and report words/sec and speedup over 1 thread.
+    if max_threads is None:
+        max_threads = os.cpu_count() or 1
+    thread_counts = [1]
+    while thread_counts[-1] * 2 <= max_threads:
+        thread_counts.append(thread_counts[-1] * 2)
+    if thread_counts[-1] != max_threads:
+        thread_counts.append(max_threads)
+
+    setupSyntheticModel(num_tokens)
+    #... warm up the JIT so compilation time is not counted
+    np.random.seed(10)
+    w2v.trainer(epochs=1, chunk_size=num_tokens, num_threads=1, plot=False)
+    w2v.trainer(epochs=1, chunk_size=num_tokens, num_threads=max(max_threads, 2), plot=False)
+
+    results = []
+    for num_threads in thread_counts:
+        np.random.seed(10)
+        start = time.time()
+        w2v.trainer(epochs=epochs, num_threads=num_threads, plot=False)
+        elapsed = time.time() - start
+        results.append({"threads": num_threads, "seconds": elapsed,
+                        "words_per_sec": epochs * num_tokens / elapsed})
+    for res in results:
+        res["speedup"] = res["words_per_sec"] / results[0]["words_per_sec"]
+    return results
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... skip-gram against CBOW throughput
+#.................................................................................
+
+
+def benchmarkModels(num_tokens=2000000, num_threads=1, epochs=1, models=("skipgram", "cbow")):
+    #... train each architecture on the same corpus with the same settings and report words/sec side by side
+    setupSyntheticModel(num_tokens)
+    for model in models:
+        w2v.trainer(epochs=1, chunk_size=10000, model=model, num_threads=num_threads, plot=False)
+
+    results = []
+    for model in models:
+        np.random.seed(10)
+        start = time.time()
+        w2v.trainer(epochs=epochs, model=model, num_threads=num_threads, plot=False)
+        elapsed = time.time() - start
+        results.append({"model": model, "threads": num_threads, "seconds": elapsed,
+                        "words_per_sec": epochs * num_tokens / elapsed})
+    return results
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... sigmoid lookup tables against the exact functions: throughput and final loss
+#.................................................................................
+
+
+def heldoutLoss(W1, W2, sequence, context_window=(-2, -1, 1, 2), num_samples=2, seed=11):
+    #... exact average negative-sampling loss per (center, context) pair on a token stream, with fixed negatives
+    [centers, contexts] = w2v.contextPairs(sequence, 0, len(sequence), np.array(context_window))
+    state = np.random.get_state()
+    np.random.seed(seed)
+    negatives = w2v.drawNegatives(len(centers) * num_samples).reshape(-1, num_samples)
+    np.random.set_state(state)
+    hidden = W1[centers]
+    positive = np.einsum('bd,bd->b', hidden, W2[contexts])
+    negative = np.einsum('bd,bkd->bk', hidden, W2[negatives])
+    return float((np.logaddexp(0, -positive).sum() + np.logaddexp(0, negative).sum()) / len(centers))
+
+
+def benchmarkSigmoid(num_tokens=2000000, settings=((0, 6), (100, 6), (1000, 6), (10000, 6), (1000, 8)), epochs=1):
+    #... train the same model with the exact functions (exp_table_size 0) and with several table
+    #... resolutions / clipping ranges; report words/sec and the exact loss on a held-out stream
+    sequence = setupSyntheticModel(num_tokens)
+    heldout = zipfSequence(100000, len(w2v.uniqueWords), seed=12)
+    w2v.trainer(epochs=1, chunk_size=10000, exp_table_size=0, plot=False)
+    w2v.trainer(epochs=1, chunk_size=10000, plot=False)
+
+    results = []
+    for (exp_table_size, max_exp) in settings:
+        np.random.seed(10)
+        start = time.time()
+        [W1, W2] = w2v.trainer(epochs=epochs, exp_table_size=exp_table_size, max_exp=max_exp, plot=False)
+        elapsed = time.time() - start
+        results.append({"exp_table_size": exp_table_size, "max_exp": max_exp,
+                        "words_per_sec": epochs * num_tokens / elapsed,
+                        "heldout_loss": heldoutLoss(W1, W2, heldout)})
+    return results
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... approximate nearest-neighbor index: recall@10 and queries/sec against brute force
+#.................................................................................
+
+
+def clusteredEmbeddings(vocab_size, hidden_size=100, num_topics=200, spread=0.5, seed=10):
+    #... synthetic embeddings with topical structure: each word is a noisy copy of one of num_topics directions
+    rng = np.random.RandomState(seed)
+    topics = rng.randn(num_topics, hidden_size)
+    return topics[rng.randint(0, num_topics, size=vocab_size)] + spread * rng.randn(vocab_size, hidden_size)
+
+
+def benchmarkAnn(vocab_size=200000, num_queries=1000, k=10, n_probes=(1, 2, 4, 8, 16, 32), num_lists=None):
+    #... build the IVF index once, then compare every n_probe setting against exact search on the same queries
+    w2v.uniqueWords = ["w%d" % i for i in range(vocab_size)]
+    w2v.wordcodes = {word: i for i, word in enumerate(w2v.uniqueWords)}
+    w2v.word_embeddings = clusteredEmbeddings(vocab_size)
+    w2v.resetQueryEngine()
+    queries = w2v.getNormalizedEmbeddings()[np.random.RandomState(11).choice(vocab_size, num_queries, replace=False)]
+
+    start = time.time()
+    w2v.buildAnnIndex(num_lists)
+    build_seconds = time.time() - start
+
+    start = time.time()
+    [exact, _] = w2v.topSimilar(queries, k)
+    exact_qps = num_queries / (time.time() - start)
+
+    results = [{"method": "exact", "recall_at_k": 1.0, "queries_per_sec": exact_qps}]
+    for n_probe in n_probes:
+        start = time.time()
+        [approx, _] = w2v.topSimilar(queries, k, n_probe=n_probe)
+        qps = num_queries / (time.time() - start)
+        hits = sum(len(np.intersect1d(exact[row], approx[row])) for row in range(num_queries))
+        results.append({"method": "ivf", "n_probe": n_probe, "recall_at_k": hits / float(num_queries * k),
+                        "queries_per_sec": qps, "build_seconds": build_seconds})
+    return results
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... reduced-precision model files: memory, queries/sec and rank-correlation loss against float64
+#.................................................................................
+
+
+def benchmarkPrecision(vocab_size=200000, num_queries=1000, k=10, pairs_file="intrinsic-test_v2.tsv",
+                       trained=False, dtypes=(np.float32, np.float16, np.int8), model_file="benchmark_model.w2v"):
+    #... export the same embeddings once per dtype with save_serving_model(), serve each file and compare it
+    #... with float64 cosine similarities: Spearman correlation of the pair similarities of pairs_file and of
+    #... the top-k scores of every query (loss = 1 - correlation), and recall@k of the top-k words.
+    #... trained uses the saved model (saved_W1.data, w2v_uniqueWords.p), otherwise synthetic embeddings are
+    #... generated with the words of pairs_file put in the vocabulary.
+    if trained:
+        w2v.uniqueWords = pickle.load(open("w2v_uniqueWords.p", "rb"))
+        embeddings = w2v.load_model()[0]
+    else:
+        pair_words = []
+        for line in open(pairs_file, encoding="utf8").readlines()[1:]:
+            pair_words.extend(word.lower() for word in line.rstrip("\n").split("\t")[1:3])
+        pair_words = sorted(set(pair_words))
+        w2v.uniqueWords = pair_words + ["w%d" % i for i in range(vocab_size - len(pair_words))]
+        embeddings = clusteredEmbeddings(len(w2v.uniqueWords))
+    w2v.wordcodes = {word: i for i, word in enumerate(w2v.uniqueWords)}
+    vocab_size = len(w2v.uniqueWords)
+    query_codes = np.random.RandomState(11).choice(vocab_size, min(num_queries, vocab_size), replace=False)
+
+    #... float64 reference
+    unit = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    [ids, pairs, gold] = w2v.loadWordPairs(pairs_file)
+    known = (pairs >= 0).all(axis=1)
+    exact_similarity = np.einsum('ij,ij->i', unit[pairs[known, 0]], unit[pairs[known, 1]])
+    exact_scores = np.dot(unit[query_codes], unit.T)
+    exact_scores[np.arange(len(query_codes)), query_codes] = -np.inf
+    exact_top = np.argsort(-exact_scores, axis=1)[:, :k]
+    results = [{"dtype": "float64", "matrix_bytes": embeddings.astype(np.float64).nbytes, "pairs": int(known.sum())}]
+
+    for dtype in dtypes:
+        w2v.word_embeddings = embeddings
+        w2v.serving_model = None
+        w2v.save_serving_model(model_file, embeddings, dtype=dtype)
+        model = w2v.load_serving_model(model_file)
+        queries = w2v.normalizedRows(query_codes)
+        w2v.topSimilar(queries[:10], k)
+        start = time.time()
+        [top, top_scores] = w2v.topSimilar(queries, k, exclude=[[code] for code in query_codes])
+        qps = len(query_codes) / (time.time() - start)
+
+        similarity = w2v.evaluateSimilarity(pairs_file)['similarity'][known]
+        score_correlation = np.mean([scipy.stats.spearmanr(top_scores[row], exact_scores[row, top[row]])[0]
+                                     for row in range(len(query_codes))])
+        hits = sum(len(np.intersect1d(exact_top[row], top[row])) for row in range(len(query_codes)))
+        matrix_bytes = model['embeddings'].nbytes + (model['scales'].nbytes if model['scales'] is not None else 0)
+        res = {"dtype": np.dtype(dtype).name, "matrix_bytes": matrix_bytes,
+               "file_bytes": os.path.getsize(model_file), "queries_per_sec": qps,
+               "pair_spearman_loss": 1 - scipy.stats.spearmanr(similarity, exact_similarity)[0],
+               "topk_spearman_loss": 1 - score_correlation,
+               "recall_at_k": hits / float(len(query_codes) * k)}
+        if gold is not None:
+            res["gold_spearman"] = scipy.stats.spearmanr(similarity, gold[known])[0]
+        results.append(res)
+    w2v.word_embeddings = embeddings
+    w2v.serving_model = None
+    w2v.resetQueryEngine()
+    os.remove(model_file)
+    return results
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... end-to-end pipeline: per-stage timings and peak memory on a generated corpus file
+#.................................................................................
+
+
+def peakRss():
+    #... peak resident set size of this process so far, in MB (ru_maxrss is in KB on Linux, bytes on macOS)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024. * 1024.) if sys.platform == "darwin" else peak / 1024.
+
+
+def runInfo():
+    #... identify the code and machine a result was measured on, so runs can be compared across commits
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count()}
+
+
+def benchmarkPipeline(num_tokens=5000000, vocab_size=50000, min_count=5, num_workers=1, epochs=2,
+                      num_threads=1, num_queries=1000, k=10, work_dir=None):
+    #... generate a Zipf corpus file, then time every stage of the pipeline separately:
+    #...   tokenize        first pass over the file (tokenize + count, countTokens)
+    #...   vocab           thresholding and ordering of the vocabulary (buildVocab)
+    #...   encode          second pass writing the token stream (encodeTokens)
+    #...   load_cached     loadData() reopening the cache entry written by a full loadData()
+    #...   sampling_table  negativeSampleTable()
+    #...   train           trainer(), with words/sec of every epoch from its metrics records
+    #...   query           prediction() one word at a time and predictionBatch() for all queries at once
+    #... each result carries the peak RSS of the process after the stage.
+    own_dir = work_dir is None
+    if own_dir:
+        work_dir = tempfile.mkdtemp(prefix="w2v_bench_")
+    corpus = os.path.join(work_dir, "corpus.tsv")
+    cache_dir = os.path.join(work_dir, "cache")
+    results = []
+
+    def record(stage, seconds, **values):
+        res = {"stage": stage, "seconds": seconds, "peak_rss_mb": peakRss()}
+        res.update(values)
+        results.append(res)
+
+    start = time.time()
+    writeZipfCorpus(corpus, num_tokens, vocab_size)
+    record("generate", time.time() - start, bytes=os.path.getsize(corpus))
+
+    ranges = w2v.splitRecordRanges(corpus, max(num_workers * 4, 1))
+    start = time.time()
+    counts = w2v.countTokens(ranges, num_workers)
+    seconds = time.time() - start
+    record("tokenize", seconds, tokens=sum(counts.values()), tokens_per_sec=sum(counts.values()) / seconds)
+
+    start = time.time()
+    [w2v.uniqueWords, w2v.wordcounts] = w2v.buildVocab(counts, min_count)
+    w2v.wordcodes = {word: i for i, word in enumerate(w2v.uniqueWords)}
+    record("vocab", time.time() - start, vocab_size=len(w2v.uniqueWords))
+
+    start = time.time()
+    w2v.encodeTokens(ranges, sum(w2v.wordcounts.values()), os.path.join(work_dir, "tokens.npy"), num_workers)
+    seconds = time.time() - start
+    record("encode", seconds, tokens_per_sec=num_tokens / seconds)
+
+    #... loadData() also writes the w2v_*.p vocabulary files to the working directory: keep them in work_dir
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    w2v.loadData(corpus, min_count, num_workers, cache_dir=cache_dir)
+    start = time.time()
+    w2v.fullsequence = w2v.loadData(corpus, min_count, num_workers, cache_dir=cache_dir)
+    record("load_cached", time.time() - start)
+    os.chdir(cwd)
+
+    start = time.time()
+    w2v.samplingTable = w2v.negativeSampleTable(w2v.fullsequence, w2v.uniqueWords, w2v.wordcounts)
+    record("sampling_table", time.time() - start, table_size=len(w2v.samplingTable))
+
+    #... warm up the JIT on a small slice so compilation time is not counted
+    full = w2v.fullsequence
+    w2v.fullsequence = full[:10000]
+    w2v.trainer(epochs=1, num_threads=num_threads, plot=False)
+    w2v.fullsequence = full
+    epoch_records = []
+    np.random.seed(10)
+    start = time.time()
+    [W1, W2] = w2v.trainer(epochs=epochs, num_threads=num_threads, plot=False,
+                           metrics_callback=lambda rec: epoch_records.append(rec) if rec['event'] == 'epoch' else None)
+    record("train", time.time() - start, threads=num_threads,
+           words_per_sec=[rec['words_per_sec'] for rec in epoch_records])
+
+    w2v.word_embeddings = W1
+    w2v.resetQueryEngine()
+    words = [w2v.uniqueWords[i] for i in np.random.RandomState(11).choice(len(w2v.uniqueWords), num_queries)
+             if w2v.uniqueWords[i] != '<UNK>']
+    w2v.predictionBatch(words[:10], k)
+    start = time.time()
+    for word in words:
+        w2v.prediction(word, k)
+    single_qps = len(words) / (time.time() - start)
+    start = time.time()
+    w2v.predictionBatch(words, k)
+    seconds = time.time() - start
+    record("query", seconds, k=k, queries=len(words), single_queries_per_sec=single_qps,
+           batch_queries_per_sec=len(words) / seconds)
+
+    if own_dir:
+        shutil.rmtree(work_dir)
+    info = runInfo()
+    info.update({"num_tokens": num_tokens, "vocab_size": vocab_size, "min_count": min_count,
+                 "num_workers": num_workers, "epochs": epochs})
+    for res in results:
+        res["run"] = info
+    return results
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... query server: throughput and latency with and without request batching
+#.................................................................................
+
+
+async def serverLoad(port, words, concurrency, k=10):
+    #... concurrency keep-alive clients sending /prediction requests for words until all are answered
+    queue = list(words)
+
+    async def client():
+        [reader, writer] = await asyncio.open_connection("127.0.0.1", port)
+        while queue:
+            word = queue.pop()
+            writer.write(("GET /prediction?word=%s&k=%d HTTP/1.1\r\nHost: localhost\r\n\r\n" % (word, k)).encode())
+            await writer.drain()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+                if line == b"\r\n":
+                    break
+            await reader.readexactly(length)
+        writer.close()
+
+    await asyncio.gather(*[client() for c in range(concurrency)])
+
+
+async def benchmarkServerRun(words, concurrency, batch_window, max_batch, port):
+    import w2v_server
+    w2v_server.batch_window = batch_window
+    w2v_server.max_batch = max_batch
+    w2v_server.stats = {'requests': {}, 'latency': {}, 'batches': 0, 'batch_sizes': w2v_server.deque(maxlen=10000)}
+    server = await w2v_server.startServer(port=port)
+    start = time.time()
+    await serverLoad(port, words, concurrency)
+    elapsed = time.time() - start
+    server.close()
+    await server.wait_closed()
+    report = w2v_server.latencyReport()
+    return {"batch_window_ms": 1000 * batch_window, "max_batch": max_batch, "concurrency": concurrency,
+            "requests_per_sec": len(words) / elapsed, "mean_batch_size": report["mean_batch_size"],
+            "latency_ms": report["latency_ms"]["prediction"]}
+
+
+def benchmarkServer(vocab_size=100000, num_requests=5000, concurrency=64,
+                    settings=((0, 1), (0, 256), (0.001, 256), (0.005, 256)), port=8765):
+    #... serve synthetic embeddings and replay the same /prediction requests for every (batch_window, max_batch)
+    #... setting; max_batch 1 answers each request on its own, window 0 only coalesces requests that are
+    #... already waiting. The prediction cache is disabled so every request is scored against the full vocabulary.
+    w2v.uniqueWords = ["w%d" % i for i in range(vocab_size)]
+    w2v.wordcodes = {word: i for i, word in enumerate(w2v.uniqueWords)}
+    w2v.word_embeddings = clusteredEmbeddings(vocab_size)
+    w2v.resetQueryEngine()
+    w2v.getNormalizedEmbeddings()
+    w2v.setPredictionCacheSize(0)
+    words = [w2v.uniqueWords[i] for i in np.random.RandomState(11).choice(vocab_size, num_requests)]
+    results = []
+    for (batch_window, max_batch) in settings:
+        results.append(asyncio.run(benchmarkServerRun(words, concurrency, batch_window, max_batch, port)))
+    w2v.setPredictionCacheSize(1024)
+    return results
+
+
+
+
+
+
+
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv)>=2 and sys.argv[1] == "threads":
+        num_tokens = int(float(sys.argv[2])) if len(sys.argv)>2 else 2000000
+        max_threads = int(sys.argv[3]) if len(sys.argv)>3 else None
+        for res in benchmarkThreads(num_tokens, max_threads):
+            print (json.dumps(res))
+    elif len(sys.argv)>=2 and sys.argv[1] == "ann":
+        vocab_size = int(float(sys.argv[2])) if len(sys.argv)>2 else 200000
+        num_queries = int(sys.argv[3]) if len(sys.argv)>3 else 1000
+        for res in benchmarkAnn(vocab_size, num_queries):
+            print (json.dumps(res))
+    elif len(sys.argv)>=2 and sys.argv[1] == "sigmoid":
+        num_tokens = int(float(sys.argv[2])) if len(sys.argv)>2 else 2000000
+        for res in benchmarkSigmoid(num_tokens):
+            print (json.dumps(res))
+    elif len(sys.argv)>=2 and sys.argv[1] == "models":
+        num_tokens = int(float(sys.argv[2])) if len(sys.argv)>2 else 2000000
+        num_threads = int(sys.argv[3]) if len(sys.argv)>3 else 1
+        for res in benchmarkModels(num_tokens, num_threads):
+            print (json.dumps(res))
+    elif len(sys.argv)>=2 and sys.argv[1] == "precision":
+        vocab_size = int(float(sys.argv[2])) if len(sys.argv)>2 else 200000
+        num_queries = int(sys.argv[3]) if len(sys.argv)>3 else 1000
+        trained = len(sys.argv)>4 and sys.argv[4] == "trained"
+        for res in benchmarkPrecision(vocab_size, num_queries, trained=trained):
+            print (json.dumps(res))
+    elif len(sys.argv)>=2 and sys.argv[1] == "pipeline":
+        num_tokens = int(float(sys.argv[2])) if len(sys.argv)>2 else 5000000
+        vocab_size = int(float(sys.argv[3])) if len(sys.argv)>3 else 50000
+        results = benchmarkPipeline(num_tokens, vocab_size)
+        output = open(sys.argv[4], "a", encoding="utf8") if len(sys.argv)>4 else None
+        for res in results:
+            print (json.dumps(res))
+            if output is not None:
+                output.write(json.dumps(res) + "\n")
+        if output is not None:
+            output.close()
+    elif len(sys.argv)>=2 and sys.argv[1] == "server":
+        vocab_size = int(float(sys.argv[2])) if len(sys.argv)>2 else 100000
+        num_requests = int(sys.argv[3]) if len(sys.argv)>3 else 5000
+        concurrency = int(sys.argv[4]) if len(sys.argv)>4 else 64
+        for res in benchmarkServer(vocab_size, num_requests, concurrency):
+            print (json.dumps(res))
+    else:
+        print ("Please provide a benchmark name: threads, ann, sigmoid, models, precision, pipeline, server")
+        sys.exit()
@@ -0,0 +1,303 @@
+import os,sys,json
+import time
+import pickle
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import word2vec_v2 as w2v
+
+
+#... Local similarity query server. The model is loaded once, then queries are answered over HTTP:
+#...
+#...     GET /prediction?word=good&k=10              top k words most similar to word
+#...     GET /analogy?a=son&b=daughter&c=man&k=10    A is to B as C is to ? (3CosAdd)
+#...     GET /similarity?word1=father&word2=son      cosine similarity of a word pair
+#...     GET /stats                                  request counts, batch sizes and latency percentiles
+#...
+#...     python w2v_server.py [model.w2v] [port | unix socket path]
+#...
+#... without a model file the saved training output (saved_W1.data, w2v_*.p) is served.
+#... requests arriving within batch_window seconds of each other are answered together: all prediction
+#... and analogy queries of a batch are scored with one matrix product against the embeddings.
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... request batching
+#.................................................................................
+
+batch_window = 0.002                    #... seconds to wait for more requests after the first one of a batch
+max_batch = 256                         #... a batch is answered at once when it reaches this many requests
+pending = []                            #... [kind, params, future] of the requests waiting for the next batch
+batch_timer = None
+executor = ThreadPoolExecutor(max_workers=1)    #... the query engine is not thread-safe: one batch at a time
+
+
+
+def submitQuery(kind, params):
+    #... queue one request for the next batch and return a future of its [status, payload]
+    global batch_timer
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    pending.append([kind, params, future])
+    if len(pending) >= max_batch:
+        flushBatch()
+    elif batch_timer is None:
+        batch_timer = loop.call_later(batch_window, flushBatch)
+    return future
+
+
+
+def flushBatch():
+    #... hand every pending request to the worker thread as one batch
+    global pending, batch_timer
+    if batch_timer is not None:
+        batch_timer.cancel()
+        batch_timer = None
+    if not pending:
+        return
+    batch = pending
+    pending = []
+    stats['batches'] += 1
+    stats['batch_sizes'].append(len(batch))
+    task = asyncio.get_running_loop().run_in_executor(executor, answerBatch, [[kind, params] for (kind, params, future) in batch])
+    task.add_done_callback(lambda done: deliverBatch(batch, done))
+
+
+
+def deliverBatch(batch, done):
+    #... answerBatch() answers every job itself; an exception here is a bug outside any request group
+    for (pos, (kind, params, future)) in enumerate(batch):
+        if future.done():
+            continue
+        if done.exception() is not None:
+            future.set_result([500, {'error': str(done.exception())}])
+        else:
+            future.set_result(done.result()[pos])
+
+
+
+def answerBatch(jobs):
+    #... answer a batch of [kind, params] jobs, returning one [status, payload] per job.
+    #... predictions (through the prediction cache) and analogies are each answered with one batched query
+    #... per distinct k, similarities with one row-wise product. A failing group only fails its own requests.
+    answers = [None] * len(jobs)
+    groups = {}
+    for (pos, (kind, params)) in enumerate(jobs):
+        try:
+            if kind == "prediction":
+                words = [params['word']]
+            elif kind == "analogy":
+                words = [params['a'], params['b'], params['c']]
+            else:
+                words = [params['word1'], params['word2']]
+            k = int(params.get('k', 10))
+            if k < 1:
+                raise ValueError("k must be at least 1")
+        except (KeyError, ValueError) as error:
+            answers[pos] = [400, {'error': "bad or missing parameter: %s" % error}]
+            continue
+        unknown = [word for word in words if word not in w2v.wordcodes]
+        if unknown:
+            answers[pos] = [404, {'error': "not in vocabulary: %s" % ", ".join(unknown)}]
+            continue
+        groups.setdefault((kind, k if kind != "similarity" else None), []).append([pos, words])
+
+    for ((kind, k), group) in groups.items():
+        try:
+            answerGroup(kind, k, group, answers)
+        except Exception as error:
+            for (pos, words) in group:
+                answers[pos] = [500, {'error': str(error)}]
+    return answers
+
+
+
+def answerGroup(kind, k, group, answers):
+    #... answer a group of [pos, words] requests of the same kind and k, storing the results in answers
+    if kind == "prediction":
+        results = w2v.predictionBatch([words[0] for (pos, words) in group], k)
+        for ((pos, words), result) in zip(group, results):
+            answers[pos] = [200, result]
+    elif kind == "analogy":
+        codes = np.array([[w2v.wordcodes[word] for word in words] for (pos, words) in group])
+        queries = w2v.normalizedRows(codes[:, 1]) - w2v.normalizedRows(codes[:, 0]) + w2v.normalizedRows(codes[:, 2])
+        [indices, scores] = w2v.topSimilar(queries, k, exclude=codes)
+        for (row, (pos, words)) in enumerate(group):
+            answers[pos] = [200, w2v.formatResults(indices[row], scores[row])]
+    else:
+        codes = np.array([[w2v.wordcodes[word] for word in words] for (pos, words) in group])
+        similarity = np.einsum('ij,ij->i', w2v.normalizedRows(codes[:, 0]), w2v.normalizedRows(codes[:, 1]))
+        for (row, (pos, words)) in enumerate(group):
+            answers[pos] = [200, {'word1': words[0], 'word2': words[1], 'similarity': float(similarity[row])}]
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... latency statistics
+#.................................................................................
+
+stats = {'requests': {}, 'latency': {}, 'batches': 0, 'batch_sizes': deque(maxlen=10000)}
+latency_window = 10000                  #... percentiles are over the last latency_window requests per endpoint
+
+
+
+def recordLatency(kind, seconds):
+    stats['requests'][kind] = stats['requests'].get(kind, 0) + 1
+    if kind not in stats['latency']:
+        stats['latency'][kind] = deque(maxlen=latency_window)
+    stats['latency'][kind].append(seconds)
+
+
+
+def latencyReport():
+    #... request counts, mean batch size and p50/p90/p99/max latency in milliseconds per endpoint
+    report = {'requests': dict(stats['requests']), 'batches': stats['batches'],
+              'mean_batch_size': float(np.mean(stats['batch_sizes'])) if stats['batch_sizes'] else 0.,
+              'latency_ms': {}, 'prediction_cache': w2v.predictionCacheInfo()}
+    for (kind, latencies) in stats['latency'].items():
+        values = 1000 * np.array(latencies)
+        [p50, p90, p99] = np.percentile(values, [50, 90, 99])
+        report['latency_ms'][kind] = {'p50': p50, 'p90': p90, 'p99': p99, 'max': float(values.max())}
+    return report
+
+
+
+
+
+
+
+
+
+
+#.................................................................................
+#... HTTP front end (HTTP/1.1 GET with keep-alive)
+#.................................................................................
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+QUERY_KINDS = ("prediction", "analogy", "similarity")
+
+
+
+async def handleConnection(reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                [name, _, value] = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            start = time.time()
+            parts = request_line.decode("latin-1").split()
+            try:
+                length = int(headers.get("content-length", 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                #... the request body cannot be delimited, so answer and close the connection
+                [status, payload] = [400, {'error': "bad Content-Length: %s" % headers["content-length"]}]
+            else:
+                if length:
+                    await reader.readexactly(length)
+                url = urlsplit(parts[1] if len(parts) > 1 else "/")
+                kind = url.path.strip("/")
+                params = {key: values[0] for (key, values) in parse_qs(url.query).items()}
+                if kind in QUERY_KINDS:
+                    [status, payload] = await submitQuery(kind, params)
+                    recordLatency(kind, time.time() - start)
+                elif kind == "stats":
+                    [status, payload] = [200, latencyReport()]
+                else:
+                    [status, payload] = [404, {'error': "unknown endpoint: %s" % url.path}]
+
+            body = json.dumps(payload).encode("utf8")
+            keep_alive = length >= 0 and headers.get("connection", "").lower() != "close" and parts[-1:] == ["HTTP/1.1"]
+            writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n"
+                          "Connection: %s\r\n\r\n" % (status, STATUS_TEXT[status], len(body),
+                                                      "keep-alive" if keep_alive else "close")).encode("latin-1") + body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+
+async def startServer(address="127.0.0.1", port=8000, unix_path=None):
+    #... start listening on a TCP port, or on a Unix socket when unix_path is given
+    if unix_path is not None:
+        return await asyncio.start_unix_server(handleConnection, unix_path)
+    return await asyncio.start_server(handleConnection, address, port)
+
+
+
+def loadServedModel(model_file=None):
+    #... a serving model file (see save_serving_model) is memory-mapped; otherwise the saved training
+    #... output is loaded: W1 from saved_W1.data and the vocabulary from the w2v_*.p files.
+    if model_file is not None:
+        w2v.load_serving_model(model_file)
+    else:
+        w2v.uniqueWords = pickle.load(open("w2v_uniqueWords.p", "rb"))
+        w2v.wordcodes = pickle.load(open("w2v_wordcodes.p", "rb"))
+        [w2v.word_embeddings, w2v.proj_embeddings] = w2v.load_model()
+        w2v.resetQueryEngine()
+    w2v.getNormalizedEmbeddings()
+
+
+
+async def serve(model_file=None, port=8000, unix_path=None):
+    loadServedModel(model_file)
+    server = await startServer(port=port, unix_path=unix_path)
+    print ("Serving ", len(w2v.uniqueWords), " words on ", unix_path if unix_path is not None else "http://127.0.0.1:%d" % port)
+    async with server:
+        await server.serve_forever()
+
+
+
+
+
+
+
+
+
+
+if __name__ == '__main__':
+    model_file = None
+    target = "8000"
+    for arg in sys.argv[1:]:
+        if arg.endswith(".w2v"):
+            model_file = arg
+        else:
+            target = arg
+    try:
+        if target.isdigit():
+            asyncio.run(serve(model_file, port=int(target)))
+        else:
+            asyncio.run(serve(model_file, unix_path=target))
+    except KeyboardInterrupt:
+        print (json.dumps(latencyReport()))
@@ -1,14 +1,24 @@
 import os,sys,re,csv
+import json
 import pickle
-from collections import Counter, defaultdict
+import struct
+import hashlib
+import multiprocessing
+from collections import Counter, defaultdict, OrderedDict
 import numpy as np
 import scipy
+import scipy.stats
+import scipy.sparse
 import math
 import random
+import time
+import glob
+import queue
+import threading
 import nltk
 from scipy.spatial.distance import cosine
 from nltk.corpus import stopwords
-from numba import jit
+from numba import jit, prange, set_num_threads, config as numba_config
 from io import open
 import operator
 import matplotlib.pyplot as plt
@@ -56,7 +66,8 @@ hidden_size = 100
 uniqueWords = [""]                      #... list of all unique tokens
 wordcodes = {}                          #... dictionary mapping of words to indices in uniqueWords
 wordcounts = Counter()                  #... how many times each token occurs
-samplingTable = []                      #... table to draw negative samples from
+rawcounts = None                        #... counts before <UNK> thresholding, when known (see updateData)
+samplingTable = np.zeros(0, dtype=np.int32)    #... table to draw negative samples from
 
 
 
@@ -69,89 +80,278 @@ samplingTable = []                      #... table to draw negative samples from
 
 
 
-def loadData(filename):
-    global uniqueWords, wordcodes, wordcounts
-    override = False
-    if override:
-        #... for debugging purposes, reloading input file and tokenizing is quite slow
-        #...  >> simply reload the completed objects. Instantaneous.
-        fullrec = pickle.load(open("w2v_fullrec.p","rb"))
-        wordcodes = pickle.load( open("w2v_wordcodes.p","rb"))
-        uniqueWords= pickle.load(open("w2v_uniqueWords.p","rb"))
-        wordcounts = pickle.load(open("w2v_wordcounts.p","rb"))
-        return fullrec
+def iterRecords(filename, start=0, end=None):
+    #... stream the review column of the TSV file one record at a time.
+    #... only records whose line starts inside the byte range [start, end) are produced, so disjoint
+    #... ranges covering the file yield every record exactly once. The header row is skipped.
+    #... the file is read line by line in buffered chunks, so memory stays bounded by the longest record.
+    handle = open(filename, "rb")
+    if start > 0:
+        #... finish the line that straddles start; it belongs to the previous range
+        handle.seek(start - 1)
+        handle.readline()
+    else:
+        handle.readline()
+    position = handle.tell()
+    while end is None or position < end:
+        entry = handle.readline()
+        if not entry:
+            break
+        position += len(entry)
+        entry = entry.decode("utf8").rstrip("\r\n")
+        if not entry:
+            continue
+        yield entry.split("\t")[1].replace("<br />", "")
+    handle.close()
 
 
-    #... load in the unlabeled data file. You can load in a subset for debugging purposes.
-    handle = open(filename, "r", encoding="utf8")
-    fullconts =handle.read().split("\n")
-    fullconts = [entry.split("\t")[1].replace("<br />", "") for entry in fullconts[1:(len(fullconts)-1)]]
 
-    #... apply simple tokenization (whitespace and lowercase)
-    fullconts = [" ".join(fullconts).lower()]
+def splitRecordRanges(filename, num_ranges):
+    #... split the file into num_ranges byte ranges of (roughly) equal size for iterRecords().
+    size = os.path.getsize(filename)
+    bounds = [int(size * i / num_ranges) for i in range(num_ranges + 1)]
+    return [(filename, bounds[i], bounds[i+1]) for i in range(num_ranges) if bounds[i+1] > bounds[i]]
 
 
 
+def tokenizeRecord(record, stop_words):
+    #... apply simple tokenization (lowercase + nltk.word_tokenize) and ignore stopwords
+    return [w for w in nltk.word_tokenize(record.lower()) if not w in stop_words]
 
 
-    print ("Generating token stream...")
-    #... populate fullrec as one-dimension array of all tokens in the order they appear.
-    #... ignore stopwords in this process
-    #... for simplicity, you may use nltk.word_tokenize() to split fullconts.
-    #... keep track of the frequency counts of tokens in origcounts.
-    fullrec = nltk.word_tokenize(fullconts[0])
-    stop_words = set(stopwords.words('english'))
-    fullrec = [w for w in fullrec if not w in stop_words]
-    min_count = 50
-    origcounts = Counter(fullrec)
 
+#... the stopword set is built lazily once per process (workers included)
+stop_word_set = None
 
+def getStopWords():
+    global stop_word_set
+    if stop_word_set is None:
+        stop_word_set = set(stopwords.words('english'))
+    return stop_word_set
 
 
 
-    print ("Performing minimum thresholding..")
-    #... populate array fullrec_filtered to include terms as-is that appeared at least min_count times
-    #... replace other terms with <UNK> token.
-    #... update frequency count of each token in dict wordcounts where: wordcounts[token] = freq(token)
-    fullrec_filtered = [w if origcounts[w] > min_count else '<UNK>' for w in fullrec ]
-    wordcounts = Counter(fullrec_filtered)
+def countRange(task):
+    #... tokenize and count one byte range of the input file. Returns a Counter whose keys are
+    #... in first-occurrence order, so merging range Counters in file order preserves that order.
+    filename, start, end = task
+    counts = Counter()
+    for record in iterRecords(filename, start, end):
+        counts.update(tokenizeRecord(record, getStopWords()))
+    return counts
 
-    #... after filling in fullrec_filtered, replace the original fullrec with this one.
-    fullrec = fullrec_filtered
 
 
+def setWordcodes(codes):
+    #... pool initializer: hand the final one-hot mapping to a worker process
+    global wordcodes
+    wordcodes = codes
 
 
 
+def encodeRange(task):
+    #... tokenize one byte range of the input file and map every token to its one-hot index
+    #... (terms missing from wordcodes map to <UNK>). Returns an int32 array.
+    filename, start, end = task
+    unk_code = wordcodes.get('<UNK>', -1)
+    codes = []
+    for record in iterRecords(filename, start, end):
+        codes.extend(wordcodes.get(w, unk_code) for w in tokenizeRecord(record, getStopWords()))
+    return np.array(codes, dtype=np.int32)
 
-    print ("Producing one-hot indicies")
-    #... (TASK) sort the unique tokens into array uniqueWords
-    #... produce their one-hot indices in dict wordcodes where wordcodes[token] = onehot_index(token)
-    #... replace all word tokens in fullrec with their corresponding one-hot indices.
-    uniqueWords = list(zip(*sorted(wordcounts.items(), key=operator.itemgetter(1), reverse=True))[0])
-    wordcodes = {key: value for (key, value) in zip(uniqueWords, xrange(0, len(uniqueWords)))}
-    fullrec = [wordcodes[x] for x in fullrec]
 
 
+#.................................................................................
+#... binary corpus cache: memory-mapped int32 token stream + compact vocab file
+#.................................................................................
 
+CACHE_VERSION = 1
 
 
-    #... close input file handle
+
+def countTokens(ranges, num_workers=1):
+    #... first pass over a file: tokenize each record, ignore stopwords and return the frequency
+    #... counts of all tokens (in first-occurrence order). No token stream is kept in memory.
+    counts = Counter()
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        for range_counts in pool.imap(countRange, ranges):
+            counts.update(range_counts)
+        pool.close()
+        pool.join()
+    else:
+        for range_counts in map(countRange, ranges):
+            counts.update(range_counts)
+    return counts
+
+
+
+def encodeTokens(ranges, num_tokens, path, num_workers=1):
+    #... second pass over a file: replace every token with its one-hot index from wordcodes and write
+    #... the int32 codes of each range straight into the .npy file path, in file order.
+    #... the total length is known from the first pass, so the file is preallocated and filled through a memmap.
+    pool = None
+    mapper = map
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=setWordcodes, initargs=(wordcodes,))
+        mapper = pool.imap
+    out = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=np.int32, shape=(num_tokens,))
+    position = 0
+    for codes in mapper(encodeRange, ranges):
+        out[position:position+len(codes)] = codes
+        position += len(codes)
+    out.flush()
+    del out
+    if pool is not None:
+        pool.close()
+        pool.join()
+    os.replace(path + ".tmp", path)
+
+
+
+def cacheKey(filename, min_count):
+    #... hash of the input file contents and of every preprocessing parameter that affects the output.
+    #... bump CACHE_VERSION whenever the tokenization or file layout changes to invalidate old caches.
+    digest = hashlib.sha1()
+    digest.update(("w2v-cache-v%d\n" % CACHE_VERSION).encode("utf8"))
+    digest.update(("min_count=%d\n" % min_count).encode("utf8"))
+    digest.update(("stopwords=%s\n" % ",".join(sorted(getStopWords()))).encode("utf8"))
+    handle = open(filename, "rb")
+    block = handle.read(1 << 20)
+    while block:
+        digest.update(block)
+        block = handle.read(1 << 20)
+    handle.close()
+    return digest.hexdigest()
+
+
+
+def loadCache(cache_prefix):
+    #... open a cached token stream (memory-mapped, read-only) and its vocab file.
+    #... the vocab file lists one "word<TAB>count" line per one-hot index, in index order.
+    #... returns None when the cache entry does not exist.
+    if not (os.path.exists(cache_prefix + ".tokens.npy") and os.path.exists(cache_prefix + ".vocab.tsv")):
+        return None
+    words = []
+    counts = Counter()
+    handle = open(cache_prefix + ".vocab.tsv", "r", encoding="utf8")
+    for line in handle:
+        word, count = line.rstrip("\n").split("\t")
+        words.append(word)
+        counts[word] = int(count)
     handle.close()
+    fullrec = np.load(cache_prefix + ".tokens.npy", mmap_mode="r")
+    return [fullrec, words, counts]
 
 
 
-    #... store these objects for later.
-    #... for debugging, don't keep re-tokenizing same data in same way.
-    #... just reload the already-processed input data with pickles.
+def writeVocab(path, words, counts):
+    #... write the vocab file atomically (temporary file + rename)
+    handle = open(path + ".tmp", "w", encoding="utf8")
+    for word in words:
+        handle.write(u"%s\t%d\n" % (word, counts[word]))
+    handle.close()
+    os.replace(path + ".tmp", path)
+
+
 
-    pickle.dump(fullrec, open("w2v_fullrec.p","wb+"))
+def writeVocabPickles():
+    #... save the current vocabulary as the w2v_*.p files. Without rawcounts a stale w2v_rawcounts.p
+    #... (from another corpus) is removed rather than left next to the new vocabulary.
     pickle.dump(wordcodes, open("w2v_wordcodes.p","wb+"))
     pickle.dump(uniqueWords, open("w2v_uniqueWords.p","wb+"))
     pickle.dump(dict(wordcounts), open("w2v_wordcounts.p","wb+"))
+    if rawcounts is not None:
+        pickle.dump(dict(rawcounts), open("w2v_rawcounts.p","wb+"))
+    elif os.path.exists("w2v_rawcounts.p"):
+        os.remove("w2v_rawcounts.p")
+
+
+
+def buildVocab(origcounts, min_count):
+    #... turn the raw token counts of the first pass into the vocabulary: returns [uniqueWords, wordcounts]
+    print ("Performing minimum thresholding..")
+    #... terms that appeared more than min_count times are kept as-is, all other terms become the <UNK> token.
+    #... update frequency count of each token in dict wordcounts where: wordcounts[token] = freq(token)
+    #... (tokens keep their first-occurrence order, exactly as Counter() over the filtered stream would give).
+    wordcounts = Counter()
+    for w, count in origcounts.items():
+        wordcounts[w if count > min_count else '<UNK>'] += count
+
+    print ("Producing one-hot indicies")
+    #... sort the unique tokens into array uniqueWords; their one-hot indices are their positions in it
+    uniqueWords = [w for (w, count) in sorted(wordcounts.items(), key=operator.itemgetter(1), reverse=True)]
+    return [uniqueWords, wordcounts]
+
+
+
+def loadData(filename, min_count=50, num_workers=1, range_bytes=64*1024*1024, cache_dir="w2v_cache"):
+    global uniqueWords, wordcodes, wordcounts, rawcounts
+
+    #... reloading input file and tokenizing is quite slow
+    #...  >> if this exact file was already processed with the same parameters, simply reopen the cache.
+    #... the token stream is memory-mapped, so this is near-instant and processes share the page cache.
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache_prefix = os.path.join(cache_dir, cacheKey(filename, min_count))
+    cached = loadCache(cache_prefix)
+    if cached is not None:
+        print ("Loading cached token stream ", cache_prefix)
+        [fullrec, uniqueWords, wordcounts] = cached
+        wordcodes = {key: value for (key, value) in zip(uniqueWords, range(0, len(uniqueWords)))}
+        rawcounts = None
+        if os.path.exists(cache_prefix + ".rawcounts.p"):
+            rawcounts = Counter(pickle.load(open(cache_prefix + ".rawcounts.p", "rb")))
+        #... the w2v_*.p files are "the saved vocabulary" (update_vectors, the query server): they may
+        #... still describe another corpus, so rewrite them for this one
+        writeVocabPickles()
+        return fullrec
+
+
+    #... split the input into byte ranges of about range_bytes each (at least a few per worker).
+    #... with num_workers > 1 the ranges are tokenized in a process pool; results are always consumed
+    #... in file order, so the output is identical to the serial path.
+    num_ranges = max(num_workers * 4, int(os.path.getsize(filename) / range_bytes) + 1)
+    ranges = splitRecordRanges(filename, num_ranges)
+
+
+
+    print ("Counting tokens...")
+    #... first pass over the file: keep track of the frequency counts of tokens in origcounts.
+    #... they are also kept as rawcounts, so that updateData() can later promote rare words.
+    origcounts = countTokens(ranges, num_workers)
+    rawcounts = origcounts
+
+
+
+
+
+    [uniqueWords, wordcounts] = buildVocab(origcounts, min_count)
+    wordcodes = {key: value for (key, value) in zip(uniqueWords, range(0, len(uniqueWords)))}
+
+
+
+
 
+    print ("Generating token stream...")
+    #... second pass over the file: replace every kept token with its one-hot index (see encodeTokens).
+    encodeTokens(ranges, sum(wordcounts.values()), cache_prefix + ".tokens.npy", num_workers)
+
+
+
+    #... store these objects for later.
+    #... for debugging, don't keep re-tokenizing same data in same way.
+    #... the next call with the same file and parameters reopens the cache instead.
+    #... the vocab file is written last, so a cache entry is only visible once complete.
+    pickle.dump(dict(rawcounts), open(cache_prefix + ".rawcounts.p","wb+"))
+    writeVocab(cache_prefix + ".vocab.tsv", uniqueWords, wordcounts)
 
-    #... output fullrec should be sequence of tokens, each represented as their one-hot index from wordcodes.
+    writeVocabPickles()
+
+
+    #... output fullrec is the sequence of tokens, each represented as their one-hot index from wordcodes,
+    #... memory-mapped from the cache rather than held in memory.
+    fullrec = np.load(cache_prefix + ".tokens.npy", mmap_mode="r")
     return fullrec
 
 
@@ -160,6 +360,67 @@ def loadData(filename):
 
 
 
+#.................................................................................
+#... incremental update: extend an existing vocabulary with the counts of a new file
+#.................................................................................
+
+def updateData(filename, min_count=50, num_workers=1, range_bytes=64*1024*1024, cache_dir="w2v_cache"):
+    global uniqueWords, wordcodes, wordcounts, rawcounts
+    #... merge the token counts of a new file into the current vocabulary (uniqueWords, wordcounts,
+    #... rawcounts as left by loadData or the w2v_*.p files) without renumbering it:
+    #... every existing word keeps its one-hot index, words whose merged count now passes min_count
+    #... are appended (most frequent first) and <UNK> takes the rest. Returns the token stream of
+    #... the new file only, encoded with the extended vocabulary and memory-mapped from cache_dir.
+    #... without rawcounts (a vocabulary saved before they were kept), the counts of words folded
+    #... into <UNK> so far are unknown and new words are promoted on their new counts alone.
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    num_ranges = max(num_workers * 4, int(os.path.getsize(filename) / range_bytes) + 1)
+    ranges = splitRecordRanges(filename, num_ranges)
+
+    print ("Counting tokens...")
+    newcounts = countTokens(ranges, num_workers)
+    merged = Counter(rawcounts) if rawcounts is not None else Counter(wordcounts)
+    merged.update(newcounts)
+
+    print ("Extending vocabulary...")
+    promoted = [w for (w, count) in sorted(merged.items(), key=operator.itemgetter(1), reverse=True)
+                if count > min_count and w not in wordcodes]
+    uniqueWords = list(uniqueWords) + promoted
+    wordcounts = Counter({w: merged[w] for w in uniqueWords if w != '<UNK>'})
+    unk_count = sum(merged.values()) - sum(wordcounts.values())
+    if unk_count > 0:
+        if '<UNK>' not in wordcodes:
+            uniqueWords.append('<UNK>')
+        wordcounts['<UNK>'] = unk_count
+    wordcodes = {key: value for (key, value) in zip(uniqueWords, range(0, len(uniqueWords)))}
+    rawcounts = merged
+    print ("New words: ", len(promoted), " vocabulary size: ", len(uniqueWords))
+
+    print ("Generating token stream...")
+    stream_path = os.path.join(cache_dir, cacheKey(filename, min_count) + ".update.tokens.npy")
+    encodeTokens(ranges, sum(newcounts.values()), stream_path, num_workers)
+
+    writeVocabPickles()
+    return np.load(stream_path, mmap_mode="r")
+
+
+
+def growModel(W1, W2, vocab_size):
+    #... append rows for the words added by updateData(), initialized like a fresh model in trainer()
+    new_rows = vocab_size - len(W1)
+    if new_rows <= 0:
+        return [W1, W2]
+    hidden = W1.shape[1]
+    W1 = np.vstack([W1, np.random.uniform(-.5, .5, size=(new_rows, hidden))])
+    W2 = np.vstack([W2, np.random.uniform(-.5, .5, size=(new_rows, hidden))])
+    return [W1, W2]
+
+
+
+
+
+
 #.................................................................................
 #... compute sigmoid value
 #.................................................................................
@@ -173,6 +434,52 @@ def sigmoid(x):
 
 
 
+#.................................................................................
+#... precomputed sigmoid / log-sigmoid lookup tables for the training kernels
+#.................................................................................
+
+def sigmoidTables(resolution=1000, max_exp=6):
+    #... sigmoid and log-sigmoid sampled at the centres of resolution equal bins over [-max_exp, max_exp]
+    #... (the EXP_TABLE of the original word2vec). resolution=0 gives empty tables, which makes the
+    #... kernels fall back to the exact functions.
+    centres = -max_exp + (np.arange(resolution) + 0.5) * (2. * max_exp / max(resolution, 1))
+    return [1 / (1 + np.exp(-centres)), -np.logaddexp(0, -centres)]
+
+
+
+@jit(nopython=True)
+def tableSigmoid(x, sig_table, max_exp):
+    #... sigmoid(x) read from the table, clamped to 0/1 outside [-max_exp, max_exp]
+    #... (the index is clamped as well: rounding can put x just below max_exp one past the last bin)
+    resolution = sig_table.shape[0]
+    if resolution == 0:
+        return sigmoid(x)
+    if x >= max_exp:
+        return 1.
+    if x <= -max_exp:
+        return 0.
+    return sig_table[min(int((x + max_exp) * (resolution / (2. * max_exp))), resolution - 1)]
+
+
+
+@jit(nopython=True)
+def tableLogSigmoid(x, logsig_table, max_exp):
+    #... log(sigmoid(x)) read from the table; outside the range it is clamped to 0 above and to x below
+    #... (log sigmoid(x) -> x for large negative x), so the NLL stays finite
+    resolution = logsig_table.shape[0]
+    if resolution == 0:
+        return np.log(sigmoid(x))
+    if x >= max_exp:
+        return 0.
+    if x <= -max_exp:
+        return x
+    return logsig_table[min(int((x + max_exp) * (resolution / (2. * max_exp))), resolution - 1)]
+
+
+
+
+
+
 
 
 
@@ -181,7 +488,7 @@ def sigmoid(x):
 #.................................................................................
 
 
-def negativeSampleTable(train_data, uniqueWords, wordcounts, exp_power=0.75):
+def negativeSampleTable(train_data, uniqueWords, wordcounts, exp_power=0.75, table_size=None, table_scale=100):
     #global wordcounts
     #... stores the normalizing denominator (count of all tokens, each count raised to exp_power)
     max_exp_count = 0
@@ -190,8 +497,8 @@ def negativeSampleTable(train_data, uniqueWords, wordcounts, exp_power=0.75):
     print ("Generating exponentiated count vectors")
     #... for each uniqueWord, compute the frequency of that word to the power of exp_power
     #... store results in exp_count_array.
-    exp_count_array = [wordcounts[x]**exp_power for x in uniqueWords]
-    max_exp_count = sum(exp_count_array)
+    exp_count_array = np.array([wordcounts[x] for x in uniqueWords], dtype=np.float64)**exp_power
+    max_exp_count = exp_count_array.sum()
 
 
 
@@ -200,30 +507,32 @@ def negativeSampleTable(train_data, uniqueWords, wordcounts, exp_power=0.75):
     #... compute the normalized probabilities of each term.
     #... using exp_count_array, normalize each value by the total value max_exp_count so that
     #... they all add up to 1. Store this corresponding array in prob_dist
-    prob_dist = np.array(exp_count_array, dtype='float') / max_exp_count
+    prob_dist = exp_count_array / max_exp_count
 
 
 
 
 
     print ("Filling up sampling table")
-    #... create a dict of size table_size where each key is a sequential number and its value is a one-hot index
-    #... the number of sequential keys containing the same one-hot index should be proportional to its prob_dist value
-    #... multiplied by table_size.
-    cumulative_dict = {}
-    table_size = 1e8
-    index = 0
-    cumulative_prob = prob_dist[0]*table_size
-    for i in range(1, int(table_size) + 1):
-        if i > int(cumulative_prob) and len(prob_dist) > index+1:
-            index += 1
-            cumulative_prob += prob_dist[index]*table_size
-        cumulative_dict[i] = index
+    #... create an int32 array of size table_size where each slot holds a one-hot index.
+    #... the number of slots containing the same one-hot index is proportional to its prob_dist value
+    #... multiplied by table_size. By default the table holds table_scale slots per vocabulary entry
+    #... (capped at the original 1e8) so memory follows the vocabulary, not a fixed size.
+    #... slot i holds the first index whose cumulative probability exceeds (i+0.5)/table_size, so index j
+    #... fills the slots up to ceil(cumulative_prob[j]*table_size - 0.5). The table is filled by one
+    #... np.repeat straight into the int32 array: only vocabulary-sized temporaries are allocated.
+    if table_size is None:
+        table_size = min(int(1e8), max(len(uniqueWords) * table_scale, 1))
+    table_size = int(table_size)
+    cumulative_prob = np.cumsum(prob_dist)
+    slot_ends = np.clip(np.ceil(cumulative_prob * table_size - 0.5), 0, table_size).astype(np.int64)
+    slot_ends[-1] = table_size
+    sampling_table = np.repeat(np.arange(len(prob_dist), dtype=np.int32), np.diff(slot_ends, prepend=0))
 
 
 
 
-    return cumulative_dict
+    return sampling_table
 
 
 
@@ -231,63 +540,421 @@ def negativeSampleTable(train_data, uniqueWords, wordcounts, exp_power=0.75):
 
 
 #.................................................................................
-#... generate a specific number of negative samples
+#... draw whole blocks of negative samples
 #.................................................................................
 
 
-def generateSamples(context_idx, num_samples):
-    global samplingTable, uniqueWords, randcounter
-    results = []
-    #... randomly sample num_samples token indices from samplingTable.
-    #... don't allow the chosen token to be context_idx.
-    #... append the chosen indices to results
-    i = 0
-    while i<num_samples:
-        id = random.randint(1, len(samplingTable))
-        if id == context_idx:
-            continue
+def drawNegatives(num_draws, table=None):
+    global samplingTable
+    if table is None:
+        table = samplingTable
+    #... draw num_draws token indices uniformly from the sampling table in one vectorized call.
+    #... the result is an int32 array that can be handed directly to the compiled kernels.
+    slots = np.random.randint(0, len(table), size=num_draws)
+    return table[slots]
+
+
+
+
+
+
+#.................................................................................
+#... Huffman tree over the vocabulary for the hierarchical softmax output layer
+#.................................................................................
+
+@jit(nopython=True)
+def buildHuffman(counts):
+    #... the linear-time Huffman construction of the original word2vec; counts must be sorted in decreasing order.
+    #... returns (codes, points, code_offsets): the path of word w is codes/points[code_offsets[w]:code_offsets[w+1]],
+    #... where points are inner-node indices (0 .. V-2, the root is V-2) and codes the branch taken at each node.
+    vocab = len(counts)
+    count = np.empty(2 * vocab, dtype=np.float64)
+    count[:vocab] = counts
+    count[vocab:] = 1e15
+    parent = np.zeros(2 * vocab, dtype=np.int64)
+    binary = np.zeros(2 * vocab, dtype=np.int8)
+    pos1 = vocab - 1
+    pos2 = vocab
+    for a in range(vocab - 1):
+        #... pick the two smallest remaining nodes
+        if pos1 >= 0 and count[pos1] < count[pos2]:
+            min1 = pos1
+            pos1 -= 1
+        else:
+            min1 = pos2
+            pos2 += 1
+        if pos1 >= 0 and count[pos1] < count[pos2]:
+            min2 = pos1
+            pos1 -= 1
         else:
-            i += 1
-            results.append(samplingTable[id])
+            min2 = pos2
+            pos2 += 1
+        count[vocab + a] = count[min1] + count[min2]
+        parent[min1] = vocab + a
+        parent[min2] = vocab + a
+        binary[min2] = 1
+
+    #... walk from every word up to the root to get the path lengths, then fill the paths root-first
+    code_offsets = np.zeros(vocab + 1, dtype=np.int64)
+    for a in range(vocab):
+        length = 0
+        b = a
+        while b != 2 * vocab - 2:
+            length += 1
+            b = parent[b]
+        code_offsets[a + 1] = code_offsets[a] + length
+    codes = np.zeros(code_offsets[vocab], dtype=np.int8)
+    points = np.zeros(code_offsets[vocab], dtype=np.int32)
+    for a in range(vocab):
+        o = code_offsets[a + 1]
+        b = a
+        while b != 2 * vocab - 2:
+            o -= 1
+            codes[o] = binary[b]
+            points[o] = parent[b] - vocab
+            b = parent[b]
+    return codes, points, code_offsets
+
+
+
+def huffmanTree(uniqueWords, wordcounts):
+    #... Huffman tree over the one-hot indices of uniqueWords, weighted by wordcounts, as flat code/point arrays
+    #... (see buildHuffman). The inner nodes are mapped onto the first V-1 rows of W2.
+    counts = np.array([wordcounts[w] for w in uniqueWords], dtype=np.float64)
+    order = np.argsort(-counts, kind="stable")
+    [codes, points, code_offsets] = buildHuffman(counts[order])
+    if np.array_equal(order, np.arange(len(order))):
+        return [codes, points, code_offsets]
+    #... uniqueWords was not sorted by count: reorder the paths back to one-hot order
+    lengths = np.diff(code_offsets)[np.argsort(order)]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    new_codes = np.zeros_like(codes)
+    new_points = np.zeros_like(points)
+    for rank, word in enumerate(order):
+        new_codes[offsets[word]:offsets[word+1]] = codes[code_offsets[rank]:code_offsets[rank+1]]
+        new_points[offsets[word]:offsets[word+1]] = points[code_offsets[rank]:code_offsets[rank+1]]
+    return [new_codes, new_points, offsets]
 
 
-    return results
 
 
 
 
+#.................................................................................
+#... hierarchical softmax output step shared by the compiled kernels
+#.................................................................................
+
+@jit(nopython=True, inline="always")
+def hierarchicalStep(W2, token, vectors, row, summation, learning_rate, codes, points, code_offsets,
+                     sig_table, logsig_table, max_exp):
+    #... train the inner nodes on token's Huffman path to predict token from vectors[row]:
+    #... at every node W2[point] should score the vector as 1 - code, so the cost is O(log V) and no
+    #... negatives are needed. Accumulates the gradient w.r.t. the vector into summation, updates the
+    #... node rows of W2 in place and returns the NLL (from the same forward pass).
+    #... (the vector is passed as matrix + row rather than as a row view, which keeps views out of the inner loop.)
+    nll = 0.
+    hidden = vectors.shape[1]
+    for o in range(code_offsets[token], code_offsets[token + 1]):
+        node = points[o]
+        f = 0.
+        for h in range(hidden):
+            f += W2[node, h] * vectors[row, h]
+        sig = tableSigmoid(f, sig_table, max_exp)
+        if codes[o] == 0:
+            nll -= tableLogSigmoid(f, logsig_table, max_exp)
+            g = sig - 1
+        else:
+            nll -= tableLogSigmoid(-f, logsig_table, max_exp)
+            g = sig
+        for h in range(hidden):
+            summation[h] += g * W2[node, h]
+            W2[node, h] -= learning_rate * g * vectors[row, h]
+    return nll
+
+
+
 
 
 
+#.................................................................................
+#... compiled skip-gram training over a contiguous range of the encoded token stream
+#.................................................................................
+
+@jit(nopython=True)
+def trainSkipgramChunk(sequence, start, end, context_window, reach, negatives, num_samples, lr_start, lr_end, W1, W2,
+                       sig_table, logsig_table, max_exp, hs, codes, points, code_offsets):
+    #... skip-gram with negative sampling: for every (center, context) pair the context row of W2 is pulled
+    #... towards W1[center] and the pair's negatives are pushed away, then W1[center] takes the summed gradient.
+    #... the loop over center positions runs inside the kernel.
+    #... sequence is the int32 token stream, [start, end) are the center positions handled here and
+    #... context positions falling outside the sequence are skipped, as are offsets beyond reach[i-start].
+    #... the learning rate decays linearly from lr_start at position start to lr_end at position end.
+    #... negatives holds num_samples pre-drawn indices per (center, context) pair, laid out by position:
+    #... the samples for center i and context k start at ((i-start)*len(context_window) + k)*num_samples.
+    #... with hs set, the hierarchical softmax over the Huffman tree (codes, points, code_offsets)
+    #... replaces negative sampling and negatives is not used.
+    #... sigmoid and log-sigmoid come from the lookup tables of sigmoidTables() (exact when the tables are empty).
+    #... returns the negative log-likelihood accumulated over the range (computed from the same forward pass).
+    nll = 0.
+    n = len(sequence)
+    width = len(context_window)
+    hidden = W1.shape[1]
+    summation = np.zeros(hidden, dtype=np.float64)
+    span = max(end - start, 1)
+    for i in range(start, end):
+        center_token = sequence[i]
+        learning_rate = lr_start + (lr_end - lr_start) * (i - start) / span
+        for h in range(hidden):
+            summation[h] = 0.
+        for k in range(width):
+            pos = i + context_window[k]
+            if pos < 0 or pos >= n or abs(context_window[k]) > reach[i - start]:
+                continue
+            token = sequence[pos]
+            if hs:
+                nll += hierarchicalStep(W2, token, W1, center_token, summation, learning_rate,
+                                        codes, points, code_offsets, sig_table, logsig_table, max_exp)
+                continue
+
+            #... positive (context) pair
+            f = 0.
+            for h in range(hidden):
+                f += W2[token, h] * W1[center_token, h]
+            sig = tableSigmoid(f, sig_table, max_exp)
+            nll -= tableLogSigmoid(f, logsig_table, max_exp)
+            g = sig - 1
+            for h in range(hidden):
+                summation[h] += g * W2[token, h]
+                W2[token, h] -= learning_rate * g * W1[center_token, h]
+
+            #... negative samples drawn for this pair
+            base = ((i - start) * width + k) * num_samples
+            for s in range(num_samples):
+                j = negatives[base + s]
+                if j == token:
+                    continue
+                f = 0.
+                for h in range(hidden):
+                    f += W2[j, h] * W1[center_token, h]
+                sig = tableSigmoid(f, sig_table, max_exp)
+                nll -= tableLogSigmoid(-f, logsig_table, max_exp)
+                for h in range(hidden):
+                    summation[h] += sig * W2[j, h]
+                    W2[j, h] -= learning_rate * sig * W1[center_token, h]
+
+        for h in range(hidden):
+            W1[center_token, h] -= learning_rate * summation[h]
+
+    return nll
+
+
+
+
+
+
+#.................................................................................
+#... compiled CBOW training over a contiguous range of the encoded token stream
+#.................................................................................
+
 @jit(nopython=True)
-def performDescent(num_samples, learning_rate, center_token, sequence_chars,W1,W2,negative_indices):
-    # sequence chars was generated from the mapped sequence in the core code
-    nll_new = 0.
-    summation = np.zeros(hidden_size, dtype=np.float64)
-    for k in range(0, len(sequence_chars)):
-        #... implement gradient descent. Find the current context token from sequence_chars
-        #... and the associated negative samples from negative_indices. Run gradient descent on both
-        #... weight matrices W1 and W2.
-        #... compute the total negative log-likelihood and store this in nll_new.
-        codes = sequence_chars[k]
-        summation += (sigmoid(np.dot(W2[codes], W1[center_token])) - 1) * W2[codes]
-        W2[codes] = W2[codes] - learning_rate*(sigmoid(np.dot(W2[codes], W1[center_token])) - 1)*W1[center_token]
+def trainCbowChunk(sequence, start, end, context_window, reach, negatives, num_samples, lr_start, lr_end, W1, W2,
+                   sig_table, logsig_table, max_exp, hs, codes, points, code_offsets):
+    #... continuous bag-of-words: the W1 rows of the context tokens are averaged into one hidden vector,
+    #... which must predict the center token through W2 (negative sampling or hierarchical softmax).
+    #... the hidden-layer gradient is then added to every context row of W1.
+    #... arguments and return value are the same as trainSkipgramChunk, except that negatives holds
+    #... num_samples indices per center position (one prediction per position instead of one per pair):
+    #... the samples for center i start at (i-start)*num_samples.
+    nll = 0.
+    n = len(sequence)
+    width = len(context_window)
+    hidden = W1.shape[1]
+    mean = np.zeros((1, hidden), dtype=np.float64)
+    summation = np.zeros(hidden, dtype=np.float64)
+    span = max(end - start, 1)
+    for i in range(start, end):
+        center_token = sequence[i]
+        learning_rate = lr_start + (lr_end - lr_start) * (i - start) / span
+
+        #... average the context rows
+        num_context = 0
+        for h in range(hidden):
+            mean[0, h] = 0.
+            summation[h] = 0.
+        for k in range(width):
+            pos = i + context_window[k]
+            if pos < 0 or pos >= n or abs(context_window[k]) > reach[i - start]:
+                continue
+            num_context += 1
+            for h in range(hidden):
+                mean[0, h] += W1[sequence[pos], h]
+        if num_context == 0:
+            continue
+        for h in range(hidden):
+            mean[0, h] /= num_context
+
+        if hs:
+            nll += hierarchicalStep(W2, center_token, mean, 0, summation, learning_rate,
+                                    codes, points, code_offsets, sig_table, logsig_table, max_exp)
+        else:
+            #... center token (label 1) followed by the negatives (label 0)
+            base = (i - start) * num_samples
+            for s in range(num_samples + 1):
+                if s == 0:
+                    target = center_token
+                else:
+                    target = negatives[base + s - 1]
+                    if target == center_token:
+                        continue
+                f = 0.
+                for h in range(hidden):
+                    f += W2[target, h] * mean[0, h]
+                sig = tableSigmoid(f, sig_table, max_exp)
+                if s == 0:
+                    nll -= tableLogSigmoid(f, logsig_table, max_exp)
+                    g = sig - 1
+                else:
+                    nll -= tableLogSigmoid(-f, logsig_table, max_exp)
+                    g = sig
+                for h in range(hidden):
+                    summation[h] += g * W2[target, h]
+                    W2[target, h] -= learning_rate * g * mean[0, h]
+
+        for k in range(width):
+            pos = i + context_window[k]
+            if pos < 0 or pos >= n or abs(context_window[k]) > reach[i - start]:
+                continue
+            for h in range(hidden):
+                W1[sequence[pos], h] -= learning_rate * summation[h]
+
+    return nll
+
+
+
+
+
+
+#.................................................................................
+#... frequent-word subsampling of the encoded token stream
+#.................................................................................
 
-        for i in range(0, num_samples):
-            j = negative_indices[2*k + i]
-            summation += (sigmoid(np.dot(W2[j], W1[center_token])) - 0) * W2[j]
-            W2[j] = W2[j] - learning_rate * (sigmoid(np.dot(W2[j], W1[center_token])) - 0) * W1[center_token]
+def keepProbabilities(uniqueWords, wordcounts, sample=1e-3, unk_code=-1):
+    #... probability of keeping each one-hot index when subsampling frequent words (Mikolov et al.):
+    #... keep(w) = (sqrt(f(w) / sample) + 1) * sample / f(w), where f(w) is the relative frequency of w.
+    #... sample=0 (or None) disables subsampling. <UNK> (unk_code) is never kept.
+    counts = np.array([wordcounts[w] for w in uniqueWords], dtype=np.float64)
+    keep_prob = np.ones(len(counts), dtype=np.float64)
+    if sample:
+        freq = counts / counts.sum()
+        seen = freq > 0
+        keep_prob[seen] = np.minimum((np.sqrt(freq[seen] / sample) + 1) * sample / freq[seen], 1.)
+    if unk_code >= 0:
+        keep_prob[unk_code] = 0.
+    return keep_prob
 
-    W1[center_token] = W1[center_token] - learning_rate*summation
 
-    for k in range(0, len(sequence_chars)):
-        codes = sequence_chars[k]
-        nll_new += -np.log(sigmoid(np.dot(W2[codes], W1[center_token])))
-        for i in range(0, num_samples):
-            j = negative_indices[2*k + i]
-            nll_new += -np.log(sigmoid(np.dot(-W2[j], W1[center_token])))
 
-    return [nll_new]
+def subsampleSequence(sequence, keep_prob):
+    #... drop tokens of an encoded stream with one vectorized random mask; returns the kept tokens in order.
+    #... called afresh every epoch, so each epoch sees a different subsample.
+    mask = np.random.random_sample(len(sequence)) < keep_prob[sequence]
+    return sequence[mask]
+
+
+
+
+
+
+#.................................................................................
+#... context windows: arbitrary offsets, optionally shrunk at random per position
+#.................................................................................
+
+def makeContextWindow(context_window):
+    #... normalize a window specification into an int32 array of offsets relative to the center token.
+    #... an int n means the symmetric window [-n, ..., -1, 1, ..., n]; otherwise any list of distinct
+    #... non-zero offsets is accepted, e.g. [1, 2, 3, 4] or [-4, -3, -2, -1].
+    if isinstance(context_window, (int, np.integer)):
+        context_window = list(range(-context_window, 0)) + list(range(1, context_window + 1))
+    offsets = [int(offset) for offset in context_window]
+    if not offsets or 0 in offsets or len(set(offsets)) != len(offsets):
+        raise ValueError("Context window must be distinct non-zero offsets: %s" % (context_window,))
+    return np.array(offsets, dtype=np.int32)
+
+
+
+def drawWindowReach(num_positions, context_window, shrink=False):
+    #... how far each position's window reaches: offsets with |offset| > reach are skipped for that position.
+    #... without shrinking every position gets the full reach; with shrinking the reach is drawn uniformly
+    #... from 1..max|offset| for every position in one call, as the original word2vec does
+    #... (nearby context words are then used more often than distant ones).
+    max_reach = int(np.abs(context_window).max())
+    if not shrink:
+        return np.full(num_positions, max_reach, dtype=np.int32)
+    return np.random.randint(1, max_reach + 1, size=num_positions).astype(np.int32)
+
+
+
+
+
+
+#.................................................................................
+#... (center, context) index pairs of the token stream
+#.................................................................................
+
+def contextPairs(sequence, start, end, context_window, reach=None):
+    #... all (center, context) index pairs for center positions [start, end) of the token stream,
+    #... generated with one vectorized step per window offset (context positions outside the sequence are dropped).
+    #... reach optionally limits each position's window (see drawWindowReach).
+    #... pairs are ordered by center position, then by offset as listed in context_window.
+    positions = np.arange(start, end)
+    offsets = np.asarray(context_window)
+    context_positions = positions[:, None] + offsets[None, :]
+    valid = (context_positions >= 0) & (context_positions < len(sequence))
+    if reach is not None:
+        valid &= np.abs(offsets)[None, :] <= np.asarray(reach)[:, None]
+    centers = np.broadcast_to(positions[:, None], context_positions.shape)[valid]
+    return [sequence[centers], sequence[context_positions[valid]]]
+
+
+
+
+
+
+#.................................................................................
+#... Hogwild multi-core training: shard a range of the token stream across threads
+#.................................................................................
+
+@jit(nopython=True, parallel=True, nogil=True)
+def trainParallel(sequence, start, end, context_window, reach, negatives, num_samples, lr_start, lr_end, W1, W2,
+                  sig_table, logsig_table, max_exp, hs, codes, points, code_offsets, num_shards, cbow):
+    #... split [start, end) into num_shards contiguous shards and run trainSkipgramChunk (or trainCbowChunk
+    #... when cbow is set) on each in parallel.
+    #... the shards update the shared W1/W2 rows in place without any locking (Hogwild); collisions are
+    #... rare because each update only touches a handful of rows.
+    #... each shard reads its own slice of reach and negatives and its own portion of the learning-rate schedule.
+    #... negatives holds num_samples indices per (center, context) pair, or per center position with cbow.
+    stride = num_samples if cbow else len(context_window) * num_samples
+    span = end - start
+    shard_nll = np.zeros(num_shards, dtype=np.float64)
+    for s in prange(num_shards):
+        lo = start + (span * s) // num_shards
+        hi = start + (span * (s + 1)) // num_shards
+        lr_lo = lr_start + (lr_end - lr_start) * (lo - start) / max(span, 1)
+        lr_hi = lr_start + (lr_end - lr_start) * (hi - start) / max(span, 1)
+        shard_negatives = negatives
+        if not hs:
+            shard_negatives = negatives[(lo - start) * stride:(hi - start) * stride]
+        if cbow:
+            shard_nll[s] = trainCbowChunk(sequence, lo, hi, context_window, reach[lo - start:hi - start],
+                                          shard_negatives, num_samples,
+                                          lr_lo, lr_hi, W1, W2, sig_table, logsig_table, max_exp,
+                                          hs, codes, points, code_offsets)
+        else:
+            shard_nll[s] = trainSkipgramChunk(sequence, lo, hi, context_window, reach[lo - start:hi - start],
+                                              shard_negatives, num_samples,
+                                              lr_lo, lr_hi, W1, W2, sig_table, logsig_table, max_exp,
+                                              hs, codes, points, code_offsets)
+    return shard_nll.sum()
 
 
 
@@ -299,25 +966,30 @@ def performDescent(num_samples, learning_rate, center_token, sequence_chars,W1,W
 #.................................................................................
 
 
-def trainer(curW1 = None, curW2=None):
+def trainer(curW1 = None, curW2=None, epochs=5, num_samples=2, learning_rate=0.05, chunk_size=1000000, num_threads=1,
+            exp_table_size=1000, max_exp=6, sample=1e-3, context_window=(-2,-1,1,2),
+            shrink_window=False, model="skipgram", output="ns", checkpoint_every=None, checkpoint_minutes=None,
+            resume_state=None, metrics_log=None, metrics_callback=None, metrics_every=None, plot=True):
     global uniqueWords, wordcodes, fullsequence, vocab_size, hidden_size,np_randcounter, randcounter
     vocab_size = len(uniqueWords)           #... unique characters
     hidden_size = 100                       #... number of hidden neurons
-    #context_window = [1, 2, 3, 4]
-    #context_window = [-4, -3, -2, -1]
-    context_window = [-2,-1,1,2]            #... specifies which context indices are output. Indices relative to target word. Don't include index 0 itself.
-    nll_results = []                        #... keep array of negative log-likelihood after every 1000 iterations
+    #... context_window specifies which context indices are output. Indices relative to target word, e.g.
+    #... [1, 2, 3, 4], [-4, -3, -2, -1] or an int n for [-n..-1, 1..n]. Don't include index 0 itself.
+    #... with shrink_window, every position uses a randomly shrunk window (see drawWindowReach).
+    nll_results = []                        #... keep array of average negative log-likelihood per token after every chunk
 
 
-    #... determine how much of the full sequence we can use while still accommodating the context window
-    start_point = int(math.fabs(min(context_window)))
-    end_point = len(fullsequence)-(max(max(context_window),0))
-    mapped_sequence = fullsequence
+    #... the encoded sequence is handed to the compiled kernel as an int32 array (no copy for an int32 memmap)
+    #... every epoch, each chunk of it is subsampled first: frequent tokens are dropped at random and <UNK> is
+    #... always dropped, so it is never used as a center or context token (sample=0 only drops <UNK>).
+    mapped_sequence = np.asarray(fullsequence, dtype=np.int32)
+    window = makeContextWindow(context_window)
+    keep_prob = keepProbabilities(uniqueWords, wordcounts, sample, wordcodes.get('<UNK>', -1))
 
 
 
     #... initialize the weight matrices. W1 is from input->hidden and W2 is from hidden->output.
-    if curW1==None:
+    if curW1 is None:
         np_randcounter += 1
         W1 = np.random.uniform(-.5, .5, size=(vocab_size, hidden_size))
         W2 = np.random.uniform(-.5, .5, size=(vocab_size, hidden_size))
@@ -328,74 +1000,275 @@ def trainer(curW1 = None, curW2=None):
 
 
 
-    #... set the training parameters
-    epochs = 5
-    num_samples = 2
-    learning_rate = 0.05
-    nll = 0
-    iternum = 0
+    #... set the training parameters (epochs, num_samples, learning_rate)
+    #... chunk_size is the number of positions of the full sequence subsampled and handed to the kernel per call;
+    #... progress, throughput (on the full sequence) and NLL (per trained token) are reported at chunk boundaries.
+    #... the learning rate decays linearly over all epochs down to min_learning_rate, as in the original word2vec.
+    #... with num_threads > 1 every chunk is sharded across that many threads (Hogwild updates).
+    #... model selects the architecture: "skipgram" (trainSkipgramChunk) or "cbow" (trainCbowChunk).
+    #... output selects the output layer: "ns" (negative sampling against samplingTable) or "hs"
+    #... (hierarchical softmax over a Huffman tree of wordcounts; no sampling table or negatives needed).
+    #... the compiled kernels read sigmoid/log-sigmoid from tables of exp_table_size entries over [-max_exp, max_exp];
+    #... exp_table_size=0 selects the exact functions.
+    #... a checkpoint is written (in a background thread) every checkpoint_every tokens of the full sequence
+    #... and/or every checkpoint_minutes minutes (both off by default; the checkpoint files are deleted once
+    #... training completes); resume_state (from load_checkpoint) continues an interrupted run.
+    #... if a checkpoint cannot be written, checkpointing stops with a message and training carries on.
+    #... training metrics (see emitMetrics) are appended to the JSONL file metrics_log and/or passed to
+    #... metrics_callback, one "chunk" record per metrics_every tokens of the full sequence (default every chunk).
+    #... plot=True shows the NLL curve without blocking, a filename saves it there instead, False skips it.
+    if model not in ("skipgram", "cbow"):
+        raise ValueError("Unknown model: %s" % model)
+    if output not in ("ns", "hs"):
+        raise ValueError("Unknown output layer: %s" % output)
+    hs = output == "hs"
+    if hs:
+        [codes, points, code_offsets] = huffmanTree(uniqueWords, wordcounts)
+    else:
+        codes = np.zeros(0, dtype=np.int8)
+        points = np.zeros(0, dtype=np.int32)
+        code_offsets = np.zeros(1, dtype=np.int64)
+    cbow = model == "cbow"
+    kernel = trainCbowChunk if cbow else trainSkipgramChunk
+    chunk_size = int(chunk_size)
+    min_learning_rate = learning_rate * 1e-4
+    total_tokens = float(epochs * len(mapped_sequence))
+    [sig_table, logsig_table] = sigmoidTables(exp_table_size, max_exp)
+    max_exp = float(max_exp)
+    if num_threads > 1:
+        set_num_threads(min(num_threads, numba_config.NUMBA_NUM_THREADS))
+
+
+
+    #... pick up where an interrupted run stopped: same position, NLL history and RNG state,
+    #... so the remaining chunks draw exactly the same subsamples and negatives.
+    first_epoch = 0
+    first_chunk = 0
+    if resume_state is not None:
+        first_epoch = resume_state['epoch']
+        first_chunk = resume_state['position']
+        chunk_size = resume_state['chunk_size']
+        epochs = resume_state['epochs']
+        learning_rate = resume_state['learning_rate']
+        min_learning_rate = resume_state['min_learning_rate']
+        total_tokens = float(epochs * len(mapped_sequence))
+        nll_results = list(resume_state['nll_results'])
+        np.random.set_state(resume_state['np_random_state'])
+        random.setstate(resume_state['random_state'])
+        print ("Resuming from epoch ", first_epoch, " position ", first_chunk)
+
+
+
+    #... checkpoints are handed to a background writer thread, so the training loop only pays for copying W1/W2
+    checkpoint_thread = None
+    checkpoint_errors = []
+    if checkpoint_every is not None or checkpoint_minutes is not None:
+        checkpoint_jobs = queue.Queue(maxsize=1)
+        checkpoint_thread = threading.Thread(target=checkpointWriter, args=(checkpoint_jobs, checkpoint_errors))
+        checkpoint_thread.daemon = True
+        checkpoint_thread.start()
+    last_checkpoint_tokens = first_epoch * len(mapped_sequence) + first_chunk
+    last_checkpoint_time = time.time()
+
+
+
+    #... metrics: the time of every chunk is split into sampling (subsampling, windows, negatives),
+    #... kernel (the training updates) and io (checkpoint hand-off, metric records); the phase totals
+    #... are reported and reset with every record.
+    metrics_handle = None
+    if metrics_log is not None:
+        metrics_handle = open(metrics_log, "a", encoding="utf8")
+    metrics_on = metrics_handle is not None or metrics_callback is not None
+    phase_seconds = {'sampling': 0., 'kernel': 0., 'io': 0.}
+    interval_tokens = 0
+    interval_start = time.time()
+    train_start = time.time()
+    if metrics_on:
+        emitMetrics({'event': 'start', 'model': model, 'output': output, 'vocab_size': vocab_size,
+                     'hidden_size': hidden_size, 'tokens': len(mapped_sequence), 'epochs': epochs,
+                     'first_epoch': first_epoch, 'chunk_size': chunk_size, 'num_threads': num_threads,
+                     'num_samples': num_samples, 'learning_rate': learning_rate,
+                     'window': [int(offset) for offset in window], 'sample': sample},
+                    metrics_handle, metrics_callback)
 
 
 
 
     #... Begin actual training
-    for j in range(0,epochs):
+    for j in range(first_epoch,epochs):
         print ("Epoch: ", j)
-        prevmark = 0
-
-        #... For each epoch, redo the whole sequence...
-        for i in range(start_point,end_point):
+        epoch_start = time.time()
+        epoch_first = first_chunk if j == first_epoch else 0
+
+        #... For each epoch, redo the whole sequence chunk by chunk...
+        epoch_nll = 0.
+        for chunk_start in range(epoch_first, len(mapped_sequence), chunk_size):
+            phase_start = time.time()
+            chunk_end = min(chunk_start + chunk_size, len(mapped_sequence))
+            chunk = subsampleSequence(mapped_sequence[chunk_start:chunk_end], keep_prob)
+            chunk_tokens = len(chunk)
+
+            #... pre-draw the negatives for every (center, context) pair of the chunk in one call, or for
+            #... every center position with cbow (not needed for hs)
+            reach = drawWindowReach(chunk_tokens, window, shrink_window)
+            if hs:
+                negative_indices = np.zeros(0, dtype=np.int32)
+            elif cbow:
+                negative_indices = drawNegatives(chunk_tokens * num_samples)
+            else:
+                negative_indices = drawNegatives(chunk_tokens * len(window) * num_samples)
+            done = j * len(mapped_sequence) + chunk_start
+            lr_start = max(learning_rate * (1 - done / total_tokens), min_learning_rate)
+            lr_end = max(learning_rate * (1 - (j * len(mapped_sequence) + chunk_end) / total_tokens), min_learning_rate)
+            phase_seconds['sampling'] += time.time() - phase_start
+            phase_start = time.time()
+            if num_threads > 1:
+                nll = trainParallel(chunk, 0, chunk_tokens, window, reach, negative_indices,
+                                    num_samples, lr_start, lr_end, W1, W2,
+                                    sig_table, logsig_table, max_exp, hs, codes, points, code_offsets,
+                                    num_threads, cbow)
+            else:
+                nll = kernel(chunk, 0, chunk_tokens, window, reach, negative_indices,
+                             num_samples, lr_start, lr_end, W1, W2,
+                             sig_table, logsig_table, max_exp, hs, codes, points, code_offsets)
+
+            phase_seconds['kernel'] += time.time() - phase_start
+            phase_start = time.time()
+            nll_results.append(nll / max(chunk_tokens, 1))
+            epoch_nll += nll
+            elapsed = time.time() - epoch_start
+            print ("Progress: ", round(float(chunk_end) / len(mapped_sequence), 3),
+                   " Negative likelihood: ", nll,
+                   " Learning rate: ", round(lr_end, 6),
+                   " Words/sec: ", int((chunk_end - epoch_first) / max(elapsed, 1e-9)))
+
+            #... periodic checkpoint of everything needed to continue after chunk_end
+            done = j * len(mapped_sequence) + chunk_end
+            if checkpoint_thread is not None and (
+                    (checkpoint_every is not None and done - last_checkpoint_tokens >= checkpoint_every) or
+                    (checkpoint_minutes is not None and time.time() - last_checkpoint_time >= 60 * checkpoint_minutes)):
+                next_epoch = j + 1 if chunk_end == len(mapped_sequence) else j
+                state = {'epoch': next_epoch, 'position': chunk_end % len(mapped_sequence),
+                         'chunk_size': chunk_size, 'learning_rate': learning_rate,
+                         'min_learning_rate': min_learning_rate, 'current_learning_rate': lr_end,
+                         'epochs': epochs, 'nll_results': list(nll_results),
+                         'np_random_state': np.random.get_state(), 'random_state': random.getstate(),
+                         'checkpoint_id': "%d_%d" % (next_epoch, chunk_end)}
+                if checkpoint_errors or not queueCheckpoint(checkpoint_jobs, checkpoint_thread, [W1.copy(), W2.copy(), state]):
+                    print ("Checkpoint writer failed, checkpointing stopped: ", checkpoint_errors.pop() if checkpoint_errors else "")
+                    checkpoint_every = None
+                    checkpoint_minutes = None
+                last_checkpoint_tokens = done
+                last_checkpoint_time = time.time()
+
+            #... metrics record for the tokens trained since the previous one
+            interval_tokens += chunk_end - chunk_start
+            if metrics_on and (metrics_every is None or interval_tokens >= metrics_every or chunk_end == len(mapped_sequence)):
+                phase_seconds['io'] += time.time() - phase_start
+                now = time.time()
+                record = {'event': 'chunk', 'epoch': j, 'position': chunk_end,
+                          'progress': float(j * len(mapped_sequence) + chunk_end) / (epochs * len(mapped_sequence)),
+                          'tokens': interval_tokens, 'seconds': now - interval_start,
+                          'words_per_sec': interval_tokens / max(now - interval_start, 1e-9),
+                          'learning_rate': lr_end, 'nll_per_token': nll_results[-1]}
+                for phase in phase_seconds:
+                    record[phase + '_seconds'] = phase_seconds[phase]
+                    phase_seconds[phase] = 0.
+                phase_start = time.time()
+                emitMetrics(record, metrics_handle, metrics_callback)
+                interval_tokens = 0
+                interval_start = now
+            phase_seconds['io'] += time.time() - phase_start
+
+        #... end of epoch
+        epoch_seconds = time.time() - epoch_start
+        print ("Epoch time: ", round(epoch_seconds, 3), " Words/sec: ", int((len(mapped_sequence) - epoch_first) / max(epoch_seconds, 1e-9)))
+        if metrics_on:
+            emitMetrics({'event': 'epoch', 'epoch': j, 'tokens': len(mapped_sequence) - epoch_first,
+                         'seconds': epoch_seconds,
+                         'words_per_sec': (len(mapped_sequence) - epoch_first) / max(epoch_seconds, 1e-9),
+                         'learning_rate': lr_end, 'nll': epoch_nll},
+                        metrics_handle, metrics_callback)
+
+
+    #... training finished: wait for the last checkpoint write, then drop the checkpoint files
+    if checkpoint_thread is not None:
+        queueCheckpoint(checkpoint_jobs, checkpoint_thread, None)
+        checkpoint_thread.join()
+        if checkpoint_errors:
+            print ("Checkpoint writer failed: ", checkpoint_errors.pop())
+    if checkpoint_thread is not None or resume_state is not None:
+        #... the run that wrote (or was resumed from) the checkpoint is complete
+        clear_checkpoint()
+    if metrics_on:
+        seconds = time.time() - train_start
+        emitMetrics({'event': 'end', 'seconds': seconds,
+                     'words_per_sec': (epochs - first_epoch) * len(mapped_sequence) / max(seconds, 1e-9),
+                     'nll_per_token': nll_results[-1] if nll_results else None},
+                    metrics_handle, metrics_callback)
+    if metrics_handle is not None:
+        metrics_handle.close()
 
-            if (float(i)/len(mapped_sequence))>=(prevmark+0.1):
-                print ("Progress: ", round(prevmark+0.1,1))
-                prevmark += 0.1
-            if iternum%10000==0 and iternum>0:
-                print ("Negative likelihood: ", nll)
-                nll_results.append(nll)
-                nll = 0
 
 
-            #... (TASK) determine which token is our current input. Remember that we're looping through mapped_sequence
-            center_token = mapped_sequence[i]
-
-            #... (TASK) don't allow the center_token to be <UNK>. move to next iteration if you found <UNK>.
-            if center_token == '<UNK>':
-                continue
-
 
-
-
-            iternum += 1
-            #... now propagate to each of the context outputs
-            mapped_context = [mapped_sequence[i+ctx] for ctx in context_window]
-            negative_indices = []
-            for q in mapped_context:
-                negative_indices += generateSamples(q, num_samples)
-            [nll_new] = performDescent(num_samples, learning_rate, center_token, mapped_context, W1,W2, negative_indices)
-            nll += nll_new
+    for nll_res in nll_results:
+        print (nll_res)
+    if plot:
+        plt.figure()
+        plt.plot(np.arange(1, len(nll_results)+1), nll_results)
+        plt.xlabel('chunk number (x %d tokens)' % chunk_size)
+        plt.ylabel('neg loglikelihood per token')
+        if plot is True:
+            plt.show(block=False)
+            plt.pause(0.001)
+        else:
+            plt.savefig(plot)
+            plt.close()
+    return [W1,W2]
 
 
 
+#.................................................................................
+#... training metrics: one JSON object per record, e.g. for comparing throughput across runs
+#.................................................................................
 
-    for nll_res in nll_results:
-        print (nll_res)
-    plt.plot(np.arange(1, len(nll_results)+1), nll_results)
-    plt.xlabel('iteration number (x 1e4)')
-    plt.ylabel('neg loglikelihood')
-    plt.show()
-    return [W1,W2]
+def emitMetrics(record, handle=None, callback=None):
+    #... record kinds written by trainer():
+    #...   start  run configuration (model, output, vocab_size, tokens, threads, ...)
+    #...   chunk  tokens, seconds and words_per_sec since the previous record, learning_rate, nll_per_token,
+    #...          and the seconds spent in the sampling, kernel and io phases over the same tokens
+    #...   epoch  epoch wall time, words_per_sec and summed nll
+    #...   end    total training time and words_per_sec
+    #... every record also carries its wall-clock time.
+    record['time'] = time.time()
+    if handle is not None:
+        handle.write(json.dumps(record) + u"\n")
+        handle.flush()
+    if callback is not None:
+        callback(record)
+
+
+
+def readMetrics(filename):
+    #... load a JSONL metrics log back as a list of records
+    handle = open(filename, "r", encoding="utf8")
+    records = [json.loads(line) for line in handle if line.strip()]
+    handle.close()
+    return records
 
 
 
 #.................................................................................
-#... Load in a previously-saved model. Loaded model's hidden and vocab size must match current model.
+#... Load in a previously-saved model. Loaded model's hidden and vocab size must match current model
+#... (update_vectors() grows a saved model to a vocabulary extended by updateData()).
 #.................................................................................
 
 def load_model():
-    handle = open("saved_W1(p6_1).data","rb")
+    handle = open("saved_W1.data","rb")
     W1 = np.load(handle)
     handle.close()
-    handle = open("saved_W2(p6_1).data","rb")
+    handle = open("saved_W2.data","rb")
     W2 = np.load(handle)
     handle.close()
     return [W1,W2]
@@ -423,6 +1296,84 @@ def save_model(W1,W2):
 
 
 
+#.................................................................................
+#... Periodic checkpoints of an ongoing training run, written atomically.
+#... A checkpoint is checkpoint_W1.<id>.data, checkpoint_W2.<id>.data and checkpoint_state.p; the state
+#... file names the id and is renamed into place last, so a crash mid-write leaves the previous checkpoint.
+#.................................................................................
+
+def save_checkpoint(W1, W2, state, prefix="checkpoint"):
+    checkpoint_id = state['checkpoint_id']
+    for (name, W) in (("W1", W1), ("W2", W2)):
+        filename = "%s_%s.%s.data" % (prefix, name, checkpoint_id)
+        handle = open(filename + ".tmp", "wb+")
+        np.save(handle, W, allow_pickle=False)
+        handle.close()
+        os.replace(filename + ".tmp", filename)
+
+    handle = open(prefix + "_state.p.tmp", "wb+")
+    pickle.dump(state, handle)
+    handle.close()
+    os.replace(prefix + "_state.p.tmp", prefix + "_state.p")
+
+    #... the new checkpoint is complete: remove the weights of older ones
+    for filename in glob.glob(prefix + "_W[12].*.data"):
+        if not filename.endswith(".%s.data" % checkpoint_id):
+            os.remove(filename)
+
+
+
+def load_checkpoint(prefix="checkpoint"):
+    #... returns [W1, W2, state] of the latest checkpoint, or None when there is none
+    if not os.path.exists(prefix + "_state.p"):
+        return None
+    state = pickle.load(open(prefix + "_state.p", "rb"))
+    weights = []
+    for name in ("W1", "W2"):
+        handle = open("%s_%s.%s.data" % (prefix, name, state['checkpoint_id']), "rb")
+        weights.append(np.load(handle))
+        handle.close()
+    return [weights[0], weights[1], state]
+
+
+
+def clear_checkpoint(prefix="checkpoint"):
+    for filename in glob.glob(prefix + "_W[12].*.data") + glob.glob(prefix + "_state.p"):
+        os.remove(filename)
+
+
+
+def checkpointWriter(jobs, errors):
+    #... background thread: write each [W1, W2, state] job from the queue until a None job arrives.
+    #... a failed write is appended to errors for the trainer to report and ends the thread.
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        try:
+            save_checkpoint(*job)
+        except Exception as error:
+            errors.append(error)
+            break
+
+
+
+def queueCheckpoint(jobs, writer, job):
+    #... hand a job to the writer thread, waiting while it is busy but never on a writer that has stopped.
+    #... returns False when the job could not be handed over.
+    while writer.is_alive():
+        try:
+            jobs.put(job, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+
+
+
+
 #... so in the word2vec network, there are actually TWO weight matrices that we are keeping track of. One of them represents the embedding
 #... of a one-hot vector to a hidden layer lower-dimensional embedding. The second represents the reversal: the weights that help an embedded
 #... vector predict similarity to a context word.
@@ -437,14 +1388,46 @@ def save_model(W1,W2):
 #.................................................................................
 word_embeddings = []
 proj_embeddings = []
-def train_vectors(preload=False):
+def train_vectors(preload=False, **kwargs):
     global word_embeddings, proj_embeddings
+    #... with preload, an interrupted run is resumed from its last checkpoint if there is one;
+    #... otherwise training continues from the saved model. kwargs are passed on to trainer().
+    resume_state = None
     if preload:
-        [curW1, curW2] = load_model()
+        checkpoint = load_checkpoint()
+        if checkpoint is not None:
+            [curW1, curW2, resume_state] = checkpoint
+        else:
+            [curW1, curW2] = load_model()
     else:
         curW1 = None
         curW2 = None
-    [word_embeddings, proj_embeddings] = trainer(curW1,curW2)
+    [word_embeddings, proj_embeddings] = trainer(curW1,curW2,resume_state=resume_state,**kwargs)
+    resetQueryEngine()
+    save_model(word_embeddings, proj_embeddings)
+
+
+
+def update_vectors(filename, min_count=50, num_workers=1, **kwargs):
+    global word_embeddings, proj_embeddings, uniqueWords, wordcodes, wordcounts, rawcounts, fullsequence, samplingTable
+    #... continue training the saved model on a new file only: the saved vocabulary (w2v_*.p) is extended
+    #... by updateData(), the saved weights grow by the new words, the sampling table is rebuilt from the
+    #... merged counts (the Huffman tree is rebuilt by trainer() for output="hs") and the result is saved.
+    #... kwargs are passed on to trainer(); a smaller learning_rate than the original run is usually enough.
+    uniqueWords = pickle.load(open("w2v_uniqueWords.p", "rb"))
+    wordcodes = pickle.load(open("w2v_wordcodes.p", "rb"))
+    wordcounts = Counter(pickle.load(open("w2v_wordcounts.p", "rb")))
+    rawcounts = None
+    if os.path.exists("w2v_rawcounts.p"):
+        rawcounts = Counter(pickle.load(open("w2v_rawcounts.p", "rb")))
+    [curW1, curW2] = load_model()
+
+    fullsequence = updateData(filename, min_count, num_workers)
+    [curW1, curW2] = growModel(curW1, curW2, len(uniqueWords))
+    print("Preparing negative sampling table")
+    samplingTable = negativeSampleTable(fullsequence, uniqueWords, wordcounts)
+    [word_embeddings, proj_embeddings] = trainer(curW1,curW2,**kwargs)
+    resetQueryEngine()
     save_model(word_embeddings, proj_embeddings)
 
 
@@ -455,19 +1438,399 @@ def train_vectors(preload=False):
 
 
 
+#.................................................................................
+#... vectorized similarity query engine over word_embeddings
+#.................................................................................
+
+normalized_embeddings = None            #... L2-normalized float32 copy of word_embeddings
+normalized_source = None                #... the word_embeddings object the copy was built from
+normalized_scales = None                #... per-row scales when normalized_embeddings is int8-quantized
+serving_model = None                    #... model file opened by load_serving_model(), see below
+engine_version = 0                      #... bumped whenever query results may change (see predictionBatch cache)
+
+
+
+def resetQueryEngine():
+    #... drop the normalized copy and the ANN index; call this whenever word_embeddings is modified in place
+    global normalized_embeddings, normalized_source, normalized_scales, ann_index, engine_version
+    normalized_embeddings = None
+    normalized_source = None
+    normalized_scales = None
+    ann_index = None
+    engine_version += 1
+
+
+
+def getNormalizedEmbeddings():
+    #... build the normalized copy once and reuse it until word_embeddings is replaced.
+    #... the result may be float16 or int8 (with normalized_scales) when serving a reduced-precision
+    #... model file, so read rows through normalizedRows() and score through similarityScores().
+    #... an ANN index built for embeddings that have since been replaced is dropped with the old copy.
+    global normalized_embeddings, normalized_source, normalized_scales, word_embeddings, engine_version, ann_index
+    if normalized_embeddings is None or normalized_source is not word_embeddings:
+        if normalized_embeddings is not None:
+            ann_index = None
+        engine_version += 1
+        if serving_model is not None and word_embeddings is serving_model['embeddings']:
+            #... a served model file stores unit-length rows: use the shared mapping as is
+            normalized_embeddings = word_embeddings
+            normalized_source = word_embeddings
+            normalized_scales = serving_model['scales']
+            return normalized_embeddings
+        embeddings = np.asarray(word_embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        normalized_embeddings = embeddings / norms
+        normalized_source = word_embeddings
+        normalized_scales = None
+    return normalized_embeddings
+
+
+
+def normalizedRows(rows):
+    #... float32 unit-length vectors of the given one-hot indices (an index array or a slice),
+    #... dequantized from the stored representation
+    embeddings = getNormalizedEmbeddings()
+    vectors = np.asarray(embeddings[rows], dtype=np.float32)
+    if normalized_scales is not None:
+        vectors = vectors * normalized_scales[rows][:, None]
+    return vectors
+
+
+
+def wordVectors(codes):
+    #... float32 word_embeddings rows of the given one-hot indices. For a served model file the original
+    #... (unnormalized, dequantized) vectors are rebuilt from the stored rows, norms and scales.
+    global word_embeddings
+    if serving_model is not None and word_embeddings is serving_model['embeddings']:
+        vectors = np.asarray(word_embeddings[codes], dtype=np.float32) * serving_model['norms'][codes][:, None]
+        if serving_model['scales'] is not None:
+            vectors = vectors * serving_model['scales'][codes][:, None]
+        return vectors
+    return np.asarray(word_embeddings[codes], dtype=np.float32)
+
+
+
+def similarityScores(queries, limit=None, block_size=65536):
+    #... cosine similarity of unit-length float32 queries against the first limit words (default all).
+    #... float32 embeddings are scored with one product; reduced-precision ones are converted and scored
+    #... block by block, so no full-precision copy of the matrix is ever held.
+    embeddings = getNormalizedEmbeddings()
+    if limit is None:
+        limit = len(embeddings)
+    limit = min(limit, len(embeddings))
+    if embeddings.dtype == np.float32 and normalized_scales is None:
+        return np.dot(queries, embeddings[:limit].T)
+    scores = np.empty((len(queries), limit), dtype=np.float32)
+    for block in range(0, limit, block_size):
+        end = min(block + block_size, limit)
+        scores[:, block:end] = np.dot(queries, normalizedRows(slice(block, end)).T)
+    return scores
+
+
+
+def topSimilar(query_vectors, k=10, exclude=None, n_probe=None):
+    #... find the k words with the highest cosine similarity to each query vector.
+    #... query_vectors is a single vector or a (batch, hidden) matrix; all queries are scored with one
+    #... matrix product against the normalized embeddings and the top k are picked with argpartition.
+    #... exclude optionally gives, per query, a list of one-hot indices that must not be returned.
+    #... returns (indices, scores), both of shape (batch, k), sorted by decreasing similarity.
+    #... with n_probe set and an ann_index built, the search is approximate (see annTopSimilar).
+    if n_probe is not None and ann_index is not None:
+        return annTopSimilar(query_vectors, k, exclude, n_probe)
+    queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    scores = similarityScores(queries / norms)
+    if exclude is not None:
+        for row, indices in enumerate(exclude):
+            scores[row, list(indices)] = -np.inf
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return [np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)]
+
+
+
+def formatResults(indices, scores):
+    #... turn one row of topSimilar() output into the list of {"word", "score"} dicts used by the query functions.
+    #... slots without a candidate (score -inf, when fewer than k words could be returned) are left out.
+    global uniqueWords
+    return [{'word': uniqueWords[index], 'score': float(score)} for (index, score) in zip(indices, scores)
+            if np.isfinite(score)]
+
+
+
+
+
+
+#.................................................................................
+#... approximate nearest-neighbor (IVF) index over the normalized embeddings
+#.................................................................................
+
+ann_index = None                        #... index used when a query passes n_probe (see buildAnnIndex)
+
+
+
+def buildAnnIndex(num_lists=None, iterations=10, sample_size=100000, seed=10):
+    #... partition the normalized embeddings into num_lists clusters with spherical k-means (inverted file index).
+    #... a query then only scans the members of the n_probe clusters whose centroids are closest to it:
+    #... more probes give higher recall at the cost of latency, n_probe = num_lists is an exact search.
+    #... the index is a dict of arrays: centroids (num_lists x hidden), and the members of cluster c are
+    #... members[offsets[c]:offsets[c+1]]. It also becomes the module-level ann_index.
+    global ann_index, engine_version
+    vocab_size = len(getNormalizedEmbeddings())
+    rng = np.random.RandomState(seed)
+    if num_lists is None:
+        num_lists = max(1, int(math.sqrt(vocab_size)))
+    num_lists = min(num_lists, vocab_size)
+
+    #... train the centroids on a sample of the vocabulary
+    if vocab_size > sample_size:
+        sample = normalizedRows(np.sort(rng.choice(vocab_size, sample_size, replace=False)))
+    else:
+        sample = normalizedRows(slice(0, vocab_size))
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)].copy()
+    for it in range(iterations):
+        assignment = np.argmax(np.dot(sample, centroids.T), axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        sizes = np.bincount(assignment, minlength=num_lists)
+        empty = sizes == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = (sums / norms).astype(np.float32)
+
+    #... assign every word to its closest centroid (in blocks to bound memory) and store the lists contiguously
+    assignment = np.empty(vocab_size, dtype=np.int32)
+    for block in range(0, vocab_size, 65536):
+        assignment[block:block+65536] = np.argmax(np.dot(normalizedRows(slice(block, block+65536)), centroids.T), axis=1)
+    members = np.argsort(assignment, kind="stable").astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=num_lists))]).astype(np.int64)
+
+    ann_index = {'centroids': centroids, 'offsets': offsets, 'members': members}
+    engine_version += 1
+    return ann_index
+
+
+
+def annTopSimilar(query_vectors, k=10, exclude=None, n_probe=1, index=None):
+    #... approximate version of topSimilar(): same arguments and return value, but each query only
+    #... scores the words in its n_probe closest clusters of the IVF index. When those hold fewer than k
+    #... candidates, further clusters are probed in order of closeness until k are found.
+    if index is None:
+        index = ann_index
+    queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    queries = queries / norms
+    centroids, offsets, members = index['centroids'], index['offsets'], index['members']
+    n_probe = min(n_probe, len(centroids))
+
+    #... rank the clusters for all queries with one matrix product
+    probes = np.argsort(-np.dot(queries, centroids.T), axis=1)
+    top_indices = np.zeros((len(queries), k), dtype=np.int64)
+    top_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    for row in range(len(queries)):
+        candidates = np.zeros(0, dtype=members.dtype)
+        probed = 0
+        while probed < len(centroids) and (probed < n_probe or len(candidates) < k):
+            cluster = probes[row, probed]
+            found = members[offsets[cluster]:offsets[cluster+1]]
+            if exclude is not None:
+                found = found[~np.isin(found, list(exclude[row]))]
+            candidates = np.concatenate([candidates, found])
+            probed += 1
+        scores = np.dot(normalizedRows(candidates), queries[row])
+        found = min(k, len(candidates))
+        if found == 0:
+            continue
+        best = np.argpartition(-scores, found - 1)[:found]
+        best = best[np.argsort(-scores[best])]
+        top_indices[row, :found] = candidates[best]
+        top_scores[row, :found] = scores[best]
+    return [top_indices, top_scores]
+
+
+
+def save_ann_index(index=None, filename="saved_ann_index.npz"):
+    #... store the IVF index next to the saved model
+    if index is None:
+        index = ann_index
+    handle = open(filename, "wb+")
+    np.savez(handle, **index)
+    handle.close()
+
+
+
+def load_ann_index(filename="saved_ann_index.npz"):
+    #... reload an IVF index saved by save_ann_index() and make it the module-level ann_index.
+    #... the index must have been built from the embeddings that are currently loaded.
+    global ann_index, engine_version
+    handle = open(filename, "rb")
+    stored = np.load(handle)
+    ann_index = {key: stored[key] for key in ('centroids', 'offsets', 'members')}
+    handle.close()
+    engine_version += 1
+    return ann_index
+
+
+
+
+
+
+#.................................................................................
+#... memory-mapped model file for serving. Layout (little-endian):
+#...   header   72 bytes: magic "W2VMODEL", format version, dtype (0 float32, 1 float16, 2 int8), vocab size,
+#...            hidden size, and the byte offsets of the vocab, the matrix, the norms, the scales (0 if none)
+#...            and the counts (0 if none). Version 1 files have a 64-byte header without the counts offset.
+#...   vocab    uniqueWords as utf-8, one word per line, in one-hot index order
+#...   matrix   (vocab size x hidden) word_embeddings with every row scaled to unit length
+#...   norms    float32 original length of every row, so word_embeddings = matrix * norms[:, None]
+#...   scales   int8 only: float32 per-row step, the unit-length row is approximately matrix * scales[:, None]
+#...   counts   int64 wordcounts of every word, when known (needed e.g. for SIF document vectors)
+#... the matrix and norms are opened with np.memmap: every process serving the same file shares one
+#... page-cache copy and opening it does not read the matrix at all.
+#.................................................................................
+
+MODEL_MAGIC = b"W2VMODEL"
+MODEL_VERSION = 2
+MODEL_HEADER = struct.Struct("<8sIIQQQQQQQ")
+MODEL_HEADER_V1 = struct.Struct("<8sIIQQQQQQ")
+MODEL_DTYPES = [np.float32, np.float16, np.int8]
+
+
+
+def save_serving_model(filename="saved_model.w2v", embeddings=None, words=None, dtype=np.float32, block_size=65536,
+                       counts=None):
+    #... write embeddings (default word_embeddings) and words (default uniqueWords) in the serving format.
+    #... counts (one per word) default to wordcounts when it covers every word; otherwise none are stored.
+    #... rows are normalized and written in blocks, so embeddings may itself be a memmap larger than memory.
+    #... dtype float32 or float16 stores the rows as is; int8 quantizes every row symmetrically with its own
+    #... scale (largest absolute value / 127), a quarter of the float32 size.
+    global word_embeddings, uniqueWords, wordcounts
+    if words is None:
+        words = uniqueWords
+    if counts is None and all(wordcounts[word] > 0 for word in words):
+        counts = [wordcounts[word] for word in words]
+    dtype = np.dtype(dtype)
+    dtype_code = [np.dtype(d) for d in MODEL_DTYPES].index(dtype)
+    [vocab_size, hidden] = (embeddings if embeddings is not None else word_embeddings).shape
+    vocab = u"\n".join(words).encode("utf8")
+    vocab_offset = MODEL_HEADER.size
+    matrix_offset = (vocab_offset + len(vocab) + 63) // 64 * 64
+    norms_offset = matrix_offset + vocab_size * hidden * dtype.itemsize
+    scales_offset = norms_offset + vocab_size * 4 if dtype == np.int8 else 0
+    counts_offset = 0
+    if counts is not None:
+        counts_offset = norms_offset + vocab_size * 4 * (2 if dtype == np.int8 else 1)
+    norms = np.zeros(vocab_size, dtype=np.float32)
+    scales = np.zeros(vocab_size, dtype=np.float32)
+
+    handle = open(filename + ".tmp", "wb+")
+    handle.write(MODEL_HEADER.pack(MODEL_MAGIC, MODEL_VERSION, dtype_code, vocab_size, hidden,
+                                   vocab_offset, matrix_offset, norms_offset, scales_offset, counts_offset))
+    handle.write(vocab)
+    handle.write(b"\0" * (matrix_offset - vocab_offset - len(vocab)))
+    for block in range(0, vocab_size, block_size):
+        if embeddings is None:
+            #... through wordVectors(), so re-exporting a served model starts from its original vectors
+            rows = wordVectors(slice(block, block+block_size))
+        else:
+            rows = np.asarray(embeddings[block:block+block_size], dtype=np.float32)
+        lengths = np.linalg.norm(rows, axis=1)
+        norms[block:block+block_size] = lengths
+        lengths[lengths == 0] = 1
+        rows = rows / lengths[:, None]
+        if dtype == np.int8:
+            steps = np.abs(rows).max(axis=1) / 127
+            scales[block:block+block_size] = steps
+            steps[steps == 0] = 1
+            rows = np.rint(rows / steps[:, None])
+        handle.write(rows.astype(dtype).tobytes())
+    handle.write(norms.tobytes())
+    if dtype == np.int8:
+        handle.write(scales.tobytes())
+    if counts is not None:
+        handle.write(np.asarray(counts, dtype=np.int64).tobytes())
+    handle.close()
+    os.replace(filename + ".tmp", filename)
+
+
+
+def open_serving_model(filename="saved_model.w2v"):
+    #... map a model file written by save_serving_model(). Returns a dict with the vocab list (words),
+    #... the read-only memmaps of the normalized matrix (embeddings), of the row lengths (norms) and,
+    #... for int8 files, of the row scales (scales, None otherwise), and the word counts (counts, None if not stored).
+    handle = open(filename, "rb")
+    [magic, version] = struct.unpack("<8sI", handle.read(12))
+    if magic != MODEL_MAGIC or version not in (1, MODEL_VERSION):
+        handle.close()
+        raise ValueError("%s is not a version 1 or %d model file" % (filename, MODEL_VERSION))
+    handle.seek(0)
+    counts_offset = 0
+    if version == 1:
+        [magic, version, dtype_code, vocab_size, hidden, vocab_offset, matrix_offset, norms_offset,
+         scales_offset] = MODEL_HEADER_V1.unpack(handle.read(MODEL_HEADER_V1.size))
+    else:
+        [magic, version, dtype_code, vocab_size, hidden, vocab_offset, matrix_offset, norms_offset,
+         scales_offset, counts_offset] = MODEL_HEADER.unpack(handle.read(MODEL_HEADER.size))
+    handle.seek(vocab_offset)
+    words = handle.read(matrix_offset - vocab_offset).rstrip(b"\0").decode("utf8").split(u"\n")
+    handle.close()
+    if vocab_size == 0:
+        words = []
+    embeddings = np.memmap(filename, dtype=MODEL_DTYPES[dtype_code], mode="r", offset=matrix_offset,
+                           shape=(vocab_size, hidden))
+    norms = np.memmap(filename, dtype=np.float32, mode="r", offset=norms_offset, shape=(vocab_size,))
+    scales = None
+    if scales_offset:
+        scales = np.memmap(filename, dtype=np.float32, mode="r", offset=scales_offset, shape=(vocab_size,))
+    counts = None
+    if counts_offset:
+        counts = np.memmap(filename, dtype=np.int64, mode="r", offset=counts_offset, shape=(vocab_size,))
+    return {'words': words, 'embeddings': embeddings, 'norms': norms, 'scales': scales, 'counts': counts}
+
+
+
+def load_serving_model(filename="saved_model.w2v"):
+    #... make a model file the one answered by the query functions: uniqueWords, wordcodes and
+    #... word_embeddings come from the file, and word_embeddings is the (unit-length) mapped matrix itself.
+    #... wordcounts comes from the file too, and is empty when the file stores no counts.
+    global serving_model, word_embeddings, proj_embeddings, uniqueWords, wordcodes, wordcounts
+    model = open_serving_model(filename)
+    uniqueWords = model['words']
+    wordcodes = {word: code for (code, word) in enumerate(uniqueWords)}
+    wordcounts = Counter()
+    if model['counts'] is not None:
+        wordcounts = Counter(dict(zip(uniqueWords, model['counts'].tolist())))
+    word_embeddings = model['embeddings']
+    proj_embeddings = []
+    serving_model = model
+    resetQueryEngine()
+    return model
+
+
+
+
+
+
 #.................................................................................
 #... for the averaged morphological vector combo, estimate the new form of the target word
 #.................................................................................
 
-def morphology(word_seq):
+def morphology(word_seq, k=10, n_probe=None):
     global word_embeddings, proj_embeddings, uniqueWords, wordcodes
-    embeddings = word_embeddings
+    embeddings = wordVectors([wordcodes[word_seq[1]]])
     vectors = [word_seq[0], # suffix averaged
-    embeddings[wordcodes[word_seq[1]]]]
+    embeddings[0]]
     vector_math = vectors[0]+vectors[1]
-    #... find whichever vector is closest to vector_math
-    #... (TASK) Use the same approach you used in function prediction() to construct a list
-    #... of top 10 most similar words to vector_math. Return this list.
+    #... find whichever vector is closest to vector_math (other than the input word itself)
+    #... and return the list of top k most similar words, as in prediction().
+    [indices, scores] = topSimilar(vector_math, k, exclude=[[wordcodes[word_seq[1]]]], n_probe=n_probe)
+    return formatResults(indices[0], scores[0])
 
 
 
@@ -479,19 +1842,183 @@ def morphology(word_seq):
 #... for the triplet (A,B,C) find D such that the analogy A is to B as C is to D is most likely
 #.................................................................................
 
-def analogy(word_seq):
+def analogy(word_seq, k=10, n_probe=None):
     global word_embeddings, proj_embeddings, uniqueWords, wordcodes
-    embeddings = word_embeddings
-    vectors = [embeddings[wordcodes[word_seq[0]]],
-    embeddings[wordcodes[word_seq[1]]],
-    embeddings[wordcodes[word_seq[2]]]]
-    vector_math = -vectors[0] + vectors[1] - vectors[2] # + vectors[3] = 0
-    #... find whichever vector is closest to vector_math
-    #... (TASK) Use the same approach you used in function prediction() to construct a list
-    #... of top 10 most similar words to vector_math. Return this list.
+    codes = [wordcodes[word] for word in word_seq[:3]]
+    embeddings = normalizedRows(codes)
+    vectors = [embeddings[0],
+    embeddings[1],
+    embeddings[2]]
+    vector_math = -vectors[0] + vectors[1] + vectors[2] # - vectors[3] = 0
+    #... find whichever vector is closest to vector_math (3CosAdd over normalized vectors),
+    #... excluding the three input words, and return the list of top k most similar words.
+    [indices, scores] = topSimilar(vector_math, k, exclude=[codes], n_probe=n_probe)
+    return formatResults(indices[0], scores[0])
+
+
+
+
+
+
+
+#.................................................................................
+#... batched evaluation of A:B::C:D analogy question files
+#.................................................................................
+
+def loadAnalogyQuestions(filename):
+    #... read a question file in the Google analogy format: ": category" header lines followed by
+    #... "A B C D" lines. Words are lowercased and mapped to one-hot indices; questions with any
+    #... word missing from wordcodes are skipped and counted in oov.
+    #... returns (categories, questions, question_category, oov) where questions is an (n, 4) int array
+    #... and question_category holds the position of each question's category in categories.
+    global wordcodes
+    categories = []
+    questions = []
+    question_category = []
+    oov = Counter()
+    handle = open(filename, "r", encoding="utf8")
+    for line in handle:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(":"):
+            categories.append(line[1:].strip())
+            continue
+        if not categories:
+            categories.append("default")
+        words = line.lower().split()
+        if len(words) != 4:
+            continue
+        if not all(word in wordcodes for word in words):
+            oov[categories[-1]] += 1
+            continue
+        questions.append([wordcodes[word] for word in words])
+        question_category.append(len(categories) - 1)
+    handle.close()
+    return [categories, np.array(questions, dtype=np.int64).reshape(-1, 4), np.array(question_category, dtype=np.int64), oov]
+
+
+
+def answerAnalogies(questions, method="add", chunk_size=256, restrict_vocab=None):
+    #... answer every A:B::C:? question (rows of an (n, 3+) index array) with the best-scoring word,
+    #... excluding A, B and C themselves. Questions are scored in chunks with matrix products against
+    #... the normalized embeddings (optionally only the restrict_vocab most frequent words).
+    #... method "add" is 3CosAdd: cos(D,B) - cos(D,A) + cos(D,C), computed as one product with B - A + C.
+    #... method "mul" is 3CosMul: cos'(D,B) * cos'(D,C) / (cos'(D,A) + 1e-3), with cos' = (cos + 1) / 2.
+    vocab_size = len(getNormalizedEmbeddings())
+    if restrict_vocab is not None:
+        vocab_size = min(vocab_size, restrict_vocab)
+    answers = np.zeros(len(questions), dtype=np.int64)
+    for start in range(0, len(questions), chunk_size):
+        chunk = questions[start:start+chunk_size]
+        a, b, c = normalizedRows(chunk[:, 0]), normalizedRows(chunk[:, 1]), normalizedRows(chunk[:, 2])
+        if method == "add":
+            scores = similarityScores(b - a + c, vocab_size)
+        elif method == "mul":
+            sim_a = (similarityScores(a, vocab_size) + 1) / 2
+            sim_b = (similarityScores(b, vocab_size) + 1) / 2
+            sim_c = (similarityScores(c, vocab_size) + 1) / 2
+            scores = sim_b * sim_c / (sim_a + 1e-3)
+        else:
+            raise ValueError("Unknown analogy method: %s" % method)
+        rows = np.arange(len(chunk))
+        for col in range(3):
+            inside = chunk[:, col] < vocab_size
+            scores[rows[inside], chunk[inside, col]] = -np.inf
+        answers[start:start+len(chunk)] = np.argmax(scores, axis=1)
+    return answers
+
+
+
+def evaluateAnalogies(filename, method="add", chunk_size=256, restrict_vocab=None):
+    #... load an analogy question file, answer all questions in batch and report accuracy per category.
+    #... returns a dict mapping each category (and "overall") to {"correct", "total", "accuracy", "oov"}.
+    [categories, questions, question_category, oov] = loadAnalogyQuestions(filename)
+    answers = answerAnalogies(questions, method, chunk_size, restrict_vocab)
+    correct = answers == questions[:, 3]
+    results = {}
+    for pos, category in enumerate(categories):
+        in_category = question_category == pos
+        total = int(in_category.sum())
+        hits = int(correct[in_category].sum())
+        results[category] = {'correct': hits, 'total': total,
+                             'accuracy': float(hits) / total if total else 0., 'oov': oov[category]}
+    total = len(questions)
+    results['overall'] = {'correct': int(correct.sum()), 'total': total,
+                          'accuracy': float(correct.sum()) / total if total else 0., 'oov': sum(oov.values())}
+    return results
+
+
+
+
+
+
+#.................................................................................
+#... batched intrinsic evaluation on word-pair similarity benchmarks
+#.................................................................................
+
+def loadWordPairs(filename, header=True):
+    #... read a tab-separated word-pair file into index arrays. Supported row layouts:
+    #... "id word1 word2", "id word1 word2 gold" and "word1 word2 gold" (gold is a human similarity score).
+    #... returns (ids, pairs, gold) where pairs is an (n, 2) array of one-hot indices (-1 for OOV words)
+    #... and gold is a float array, or None when the file has no gold scores.
+    global wordcodes
+    ids = []
+    pairs = []
+    gold = []
+    handle = open(filename, "r", encoding="utf8")
+    reader = csv.reader(handle, delimiter='\t', quoting=csv.QUOTE_NONE)
+    if header:
+        next(reader, None)
+    for row in reader:
+        if len(row) < 3:
+            continue
+        if len(row) == 3:
+            try:
+                score = float(row[2])
+                row = [str(len(ids)), row[0], row[1], score]
+            except ValueError:
+                pass
+        ids.append(row[0])
+        pairs.append([wordcodes.get(row[1].lower(), -1), wordcodes.get(row[2].lower(), -1)])
+        if len(row) > 3:
+            gold.append(float(row[3]))
+    handle.close()
+    gold = np.array(gold, dtype=np.float64) if len(gold) == len(ids) and ids else None
+    return [ids, np.array(pairs, dtype=np.int64).reshape(-1, 2), gold]
+
+
+
+def evaluateSimilarity(filename, oov="skip", header=True):
+    #... cosine similarity of every word pair of a benchmark file, computed in one batched operation
+    #... over the normalized embeddings. OOV pairs are counted; with oov="skip" their similarity is NaN
+    #... and they are left out of the correlation, with oov="zero" they score 0 and are kept.
+    #... returns a dict with ids, similarity, the oov count and, when the file has gold scores,
+    #... the Spearman rank correlation against them (spearman, with p-value spearman_p).
+    [ids, pairs, gold] = loadWordPairs(filename, header)
+    known = (pairs >= 0).all(axis=1)
+    similarity = np.full(len(pairs), np.nan if oov == "skip" else 0., dtype=np.float64)
+    left = normalizedRows(pairs[known, 0])
+    right = normalizedRows(pairs[known, 1])
+    similarity[known] = np.einsum('ij,ij->i', left, right)
+    results = {'ids': ids, 'similarity': similarity, 'oov': int((~known).sum()), 'pairs': len(pairs)}
+    if gold is not None:
+        scored = known if oov == "skip" else np.ones(len(pairs), dtype=bool)
+        if scored.sum() > 1:
+            [results['spearman'], results['spearman_p']] = scipy.stats.spearmanr(similarity[scored], gold[scored])
+    return results
 
 
 
+def writeSimilarityResults(results, filename):
+    #... write the per-pair similarities of evaluateSimilarity() as an id,similarity csv file
+    with open(filename, 'w', newline='') as csvfile:
+        fieldname = ['id', 'similarity']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldname, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows({'id': pair_id, 'similarity': sim} for (pair_id, sim) in zip(results['ids'], results['similarity']))
+
+
 
 
 
@@ -501,26 +2028,201 @@ def analogy(word_seq):
 #.................................................................................
 
 
-def prediction(target_word):
+def prediction(target_word, k=10, n_probe=None):
     global word_embeddings, uniqueWords, wordcodes
-    targets = [target_word]
-    outputs = []
-    similarities = []
-    target_code = wordcodes[target_word]
-    for word in uniqueWords:
-        word_code = wordcodes[word]
-        similarities.append(1 - cosine(word_embeddings[word_code],word_embeddings[target_code]))
-
-    top_index = sorted(range(len(similarities)), key=lambda i: similarities[i])[-11:-1]
-    for index in top_index:
-        outputs.append({'word': uniqueWords[index], 'score': similarities[index]})
-    #... (TASK) search through all uniqueWords and for each token, compute its similarity to target_word.
-    #... you will compute this using the absolute cosine similarity of the word_embeddings for the word pairs.
-    #... Note that the cosine() function from scipy.spatial.distance computes a DISTANCE so you need to convert that to a similarity.
-    #... return a list of top 10 most similar words in the form of dicts,
+    #... compute the cosine similarity of target_word to every token in uniqueWords with one matrix-vector product
+    #... and return a list of top k most similar words (the target itself excluded) in the form of dicts,
     #... each dict having format: {"word":<token_name>, "score":<cosine_similarity>}
+    #... pass n_probe to search approximately through ann_index instead (fewer probes: faster, lower recall).
+    return predictionBatch([target_word], k, n_probe)[0]
+
+
+
+def predictionBatch(target_words, k=10, n_probe=None):
+    global word_embeddings, uniqueWords, wordcodes
+    #... same as prediction() for a list of target words, answered with a single matrix-matrix product.
+    #... returns one result list per target word.
+    #... results are kept in an LRU cache (see prediction_cache): only the words missing from it are queried.
+    getNormalizedEmbeddings()
+    if prediction_cache_version != engine_version:
+        clearPredictionCache()
+    results = [None] * len(target_words)
+    missing = OrderedDict()
+    for (pos, word) in enumerate(target_words):
+        cached = prediction_cache.get((word, k, n_probe))
+        if cached is not None:
+            prediction_cache.move_to_end((word, k, n_probe))
+            prediction_cache_stats['hits'] += 1
+            results[pos] = [dict(res) for res in cached]
+        else:
+            missing.setdefault(word, []).append(pos)
+    if not missing:
+        return results
+
+    prediction_cache_stats['misses'] += len(missing)
+    target_codes = [wordcodes[word] for word in missing]
+    [indices, scores] = topSimilar(normalizedRows(target_codes), k, exclude=[[code] for code in target_codes], n_probe=n_probe)
+    for (row, word) in enumerate(missing):
+        found = formatResults(indices[row], scores[row])
+        for pos in missing[word]:
+            results[pos] = [dict(res) for res in found]
+        if prediction_cache_size > 0:
+            prediction_cache[(word, k, n_probe)] = found
+            if len(prediction_cache) > prediction_cache_size:
+                prediction_cache.popitem(last=False)
+                prediction_cache_stats['evictions'] += 1
+    return results
 
-    return outputs
+
+
+#... LRU cache of predictionBatch() results keyed by (word, k, n_probe). It is dropped as soon as
+#... engine_version changes, i.e. when word_embeddings is replaced (reloaded or retrained), resetQueryEngine()
+#... is called or the ANN index changes. hits/misses/evictions count single words and help size the cache.
+prediction_cache = OrderedDict()
+prediction_cache_size = 1024            #... maximum number of cached results, 0 disables the cache
+prediction_cache_version = 0
+prediction_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+
+def clearPredictionCache():
+    global prediction_cache_version
+    prediction_cache.clear()
+    prediction_cache_version = engine_version
+
+
+
+def setPredictionCacheSize(size):
+    #... change the maximum number of cached results, evicting the least recently used ones if needed
+    global prediction_cache_size
+    prediction_cache_size = size
+    while len(prediction_cache) > max(size, 0):
+        prediction_cache.popitem(last=False)
+        prediction_cache_stats['evictions'] += 1
+
+
+
+def predictionCacheInfo(reset=False):
+    #... counters of the prediction cache: hits, misses, evictions, hit_rate, size and max_size.
+    #... reset sets the counters back to zero after reading them.
+    info = dict(prediction_cache_stats)
+    lookups = info['hits'] + info['misses']
+    info['hit_rate'] = float(info['hits']) / lookups if lookups else 0.
+    info['size'] = len(prediction_cache)
+    info['max_size'] = prediction_cache_size
+    if reset:
+        for key in prediction_cache_stats:
+            prediction_cache_stats[key] = 0
+    return info
+
+
+
+
+
+
+
+#.................................................................................
+#... batch embedding of token lists: phrase and document vectors
+#.................................................................................
+
+def encodeDocuments(documents, oov="drop", lower=True):
+    #... map a list of token lists to one-hot indices in one pass. Returns (codes, offsets): the codes of
+    #... document d are codes[offsets[d]:offsets[d+1]]. With oov="unk" unknown tokens map to <UNK>
+    #... (dropped if the vocabulary has none), with oov="drop" they are left out.
+    #... note that the <UNK> row is never trained (trainer drops <UNK> from the stream), so "drop" is the default.
+    global wordcodes
+    if oov not in ("unk", "drop"):
+        raise ValueError("Unknown oov mode: %s" % oov)
+    unk_code = wordcodes.get('<UNK>', -1) if oov == "unk" else -1
+    codes = []
+    offsets = [0]
+    for tokens in documents:
+        for token in tokens:
+            code = wordcodes.get(token.lower() if lower else token, unk_code)
+            if code >= 0:
+                codes.append(code)
+        offsets.append(len(codes))
+    return [np.array(codes, dtype=np.int32), np.array(offsets, dtype=np.int64)]
+
+
+
+def chunkDocuments(documents, chunk_size):
+    #... split any iterable of documents into lists of at most chunk_size documents
+    chunk = []
+    for tokens in documents:
+        chunk.append(tokens)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+
+def inverseDocumentFrequencies(documents, oov="drop", lower=True, chunk_size=10000):
+    #... smoothed idf of every vocabulary entry, log((1 + n) / (1 + df)) + 1, over an iterable of token lists
+    #... (streamed in chunks of chunk_size documents). Used as the idf of documentVectors(pooling="tfidf").
+    global uniqueWords
+    frequencies = np.zeros(len(uniqueWords), dtype=np.int64)
+    num_documents = 0
+    for chunk in chunkDocuments(documents, chunk_size):
+        [codes, offsets] = encodeDocuments(chunk, oov, lower)
+        rows = np.repeat(np.arange(len(chunk)), np.diff(offsets))
+        frequencies += np.bincount(np.unique(rows * len(uniqueWords) + codes) % len(uniqueWords),
+                                   minlength=len(uniqueWords))
+        num_documents += len(chunk)
+    return np.log((1. + num_documents) / (1. + frequencies)) + 1
+
+
+
+def iterDocumentVectors(documents, pooling="mean", oov="drop", lower=True, chunk_size=10000,
+                        normalize=False, sif_a=1e-3, idf=None):
+    #... streaming version of documentVectors(): yields one float32 (chunk, hidden) matrix per chunk_size
+    #... documents, so memory stays bounded however many documents the iterable produces.
+    global wordcounts, uniqueWords
+    if pooling == "sif":
+        frequency = np.array([wordcounts[word] for word in uniqueWords], dtype=np.float64)
+        if len(frequency) == 0 or (frequency <= 0).any():
+            raise ValueError("sif pooling needs wordcounts for every word of uniqueWords "
+                             "(a served model file without stored counts has none)")
+        token_weights = sif_a / (sif_a + frequency / frequency.sum())
+    elif pooling == "tfidf":
+        if idf is None:
+            raise ValueError("tfidf pooling needs idf (see inverseDocumentFrequencies)")
+        token_weights = np.asarray(idf, dtype=np.float64)
+    elif pooling == "mean":
+        token_weights = None
+    else:
+        raise ValueError("Unknown pooling: %s" % pooling)
+
+    for chunk in chunkDocuments(documents, chunk_size):
+        [codes, offsets] = encodeDocuments(chunk, oov, lower)
+        #... pool with one sparse (documents x distinct words) product over the rows the chunk uses;
+        #... repeated tokens add up, which gives the term frequency of tf-idf.
+        [used, columns] = np.unique(codes, return_inverse=True)
+        rows = np.repeat(np.arange(len(chunk)), np.diff(offsets))
+        weights = np.ones(len(codes)) if token_weights is None else token_weights[codes]
+        totals = np.bincount(rows, weights=weights, minlength=len(chunk))
+        totals[totals == 0] = 1
+        pool = scipy.sparse.csr_matrix((weights / totals[rows], (rows, columns.ravel())),
+                                       shape=(len(chunk), len(used)))
+        vectors = normalizedRows(used) if normalize else wordVectors(used)
+        yield np.asarray(pool.dot(vectors), dtype=np.float32)
+
+
+
+def documentVectors(documents, pooling="mean", oov="drop", lower=True, chunk_size=10000,
+                    normalize=False, sif_a=1e-3, idf=None):
+    #... one vector per token list of documents, returned as a float32 (documents, hidden) matrix.
+    #... pooling "mean" averages the word vectors; "sif" weights each word by a / (a + p(word)) with
+    #... p from wordcounts (smooth inverse frequency, without the common-component removal);
+    #... "tfidf" weights each occurrence by idf[word]. Weighted sums are divided by the total weight.
+    #... normalize pools unit-length word vectors instead of the raw word_embeddings rows.
+    #... documents with no known token get a zero vector.
+    blocks = list(iterDocumentVectors(documents, pooling, oov, lower, chunk_size, normalize, sif_a, idf))
+    if not blocks:
+        return np.zeros((0, getNormalizedEmbeddings().shape[1]), dtype=np.float32)
+    return np.vstack(blocks)
 
 
 
@@ -557,6 +2259,9 @@ if __name__ == '__main__':
         #... If you just want to load an earlier model and NOT perform further training, comment out the train_vectors() line
         #... ... and uncomment the load_model() line
 
+        #... to answer queries from a model file shared between processes, use load_serving_model() instead
+        #... (write one with save_serving_model() after training).
+
         #train_vectors(preload=False)
         [word_embeddings, proj_embeddings] = load_model()
 
@@ -578,7 +2283,7 @@ if __name__ == '__main__':
                 target_result.append({'target_word': targ, 'similar_word': pred['word'], 'similar_score': pred['score']})
             print ("\n")
 
-        with open('output.txt', 'wb') as csvfile:
+        with open('output.txt', 'w', newline='') as csvfile:
             fieldname = ['target_word', 'similar_word', 'similar_score']
             writer = csv.DictWriter(csvfile, fieldnames=fieldname, lineterminator='\n')
             writer.writeheader()
@@ -611,21 +2316,12 @@ if __name__ == '__main__':
         print (morphology([s_suffix, "secrets"]))
 
 
-        similar_result = []
-        with open('intrinsic-test_v2.tsv') as f1:
-            reader = csv.reader(f1, delimiter='\t', quoting=csv.QUOTE_NONE)
-            next(reader)
-            for row in reader:
-                word1 = wordcodes[row[1]]
-                word2 = wordcodes[row[2]]
-                similarity = cosine(word_embeddings[word1], word_embeddings[word2])
-                similar_result.append({'id': row[0], 'similarity': similarity})
-
-        with open('intrinsic-test_res.csv', 'wb') as csvfile:
-            fieldname = ['id', 'similarity']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldname, lineterminator='\n')
-            writer.writeheader()
-            writer.writerows(similar_result)
+        #... intrinsic similarity task: cosine similarity of each word pair, OOV pairs are skipped
+        similarity_results = evaluateSimilarity('intrinsic-test_v2.tsv')
+        print ("Word pairs: ", similarity_results['pairs'], " OOV pairs: ", similarity_results['oov'])
+        if 'spearman' in similarity_results:
+            print ("Spearman correlation: ", similarity_results['spearman'])
+        writeSimilarityResults(similarity_results, 'intrinsic-test_res.csv')
 
 
 